@@ -0,0 +1,42 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from 分布式任务队列 import open_work_queue
+
+@pytest.fixture(params=["queue", "queue.db"])
+def queue_path(request, tmp_path):
+    return str(tmp_path / request.param)
+
+# A 的租约过期后任务被 B 重新领取：A 的续租、完成和出错都不能影响 B 持有的租约
+def test_stale_owner_cannot_touch_reclaimed_task(queue_path):
+    worker_a = open_work_queue(queue_path, lease_seconds=0.2)
+    worker_b = open_work_queue(queue_path, lease_seconds=0.2)
+    worker_a.enqueue_all([(0, "0.json", {"x": 0})])
+    worker_a.mark_ready()
+    assert worker_a.claim("a")["idx"] == 0
+    time.sleep(0.3)
+    assert worker_b.claim("b")["idx"] == 0
+    worker_a.renew_held()
+    worker_a.fail(0)
+    worker_a.complete(0)
+    assert worker_b.stats() == {"pending": 0, "leased": 1, "done": 0, "failed": 0}
+    worker_b.fail(0)
+    assert worker_b.stats()["pending"] == 1
+    assert worker_b.claim("b")["idx"] == 0
+    worker_b.complete(0)
+    assert worker_b.stats() == {"pending": 0, "leased": 0, "done": 1, "failed": 0}
+
+def test_failed_task_is_retried_until_max_attempts(queue_path):
+    queue = open_work_queue(queue_path, max_attempts=2)
+    queue.enqueue_all([(0, "0.json", {"x": 0})])
+    queue.mark_ready()
+    for _ in range(2):
+        assert queue.claim("a")["idx"] == 0
+        queue.fail(0)
+    assert queue.claim("a") is None
+    assert queue.failed_tasks() == [0]
@@ -0,0 +1,60 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from 结果文件读写 import open_results_stream, write_result_record, read_results_stream, iter_test_results
+
+def record(test_id):
+    return {"test_id": test_id, "file_name": f"{test_id}.json", "dialogue": [], "chat_history": {"round_1": {"final_result": "结果" * 40}}}
+
+# 在子进程中写入若干条记录后直接 os._exit，模拟 worker 被中途终止（gzip 文件缺少结尾）
+def kill_writer(path, test_ids):
+    code = (
+        "import os, sys\n"
+        f"sys.path.insert(0, {ROOT!r})\n"
+        "from 结果文件读写 import open_results_stream, write_result_record\n"
+        f"stream = open_results_stream({path!r}, 'w')\n"
+        f"for test_id in {list(test_ids)!r}:\n"
+        "    write_result_record(stream, {'test_id': test_id, 'file_name': f'{test_id}.json', 'dialogue': [], 'chat_history': {}})\n"
+        "os._exit(0)\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+def test_truncated_gzip_shard_keeps_written_records(tmp_path):
+    path = str(tmp_path / "shard_w1.jsonl.gz")
+    kill_writer(path, [1, 2])
+    assert [item["test_id"] for item in read_results_stream(path)] == [1, 2]
+
+def test_partial_last_line_is_skipped(tmp_path):
+    path = str(tmp_path / "shard_w1.jsonl")
+    with open_results_stream(path, "w") as stream:
+        write_result_record(stream, record(1))
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"test_id": 2, "file_na')
+    assert [item["test_id"] for item in read_results_stream(path)] == [1]
+
+# 导入框架只创建代理，不连接模型；配置需要三项（llm_config 与 llm_config2）
+def test_merge_after_killed_worker_restarts(tmp_path, monkeypatch):
+    config = tmp_path / "config.json"
+    config.write_text(json.dumps([{"model": "llama3.1", "api_type": "ollama"}] * 3), encoding="utf-8")
+    monkeypatch.setenv("QAI_CONFIG_LIST", str(config))
+    framework = pytest.importorskip("读取数据集用框架")
+    output_dir = str(tmp_path / "out")
+    os.makedirs(output_dir)
+    first = framework.new_shard_file(output_dir, "w1", "jsonl.gz")
+    kill_writer(first, [1, 2])
+    second = framework.new_shard_file(output_dir, "w1", "jsonl.gz")
+    assert second != first
+    with open_results_stream(second, "w") as stream:
+        write_result_record(stream, record(3))
+    framework.merge_shards(output_dir)
+    results_file = next(name for name in os.listdir(output_dir) if name.startswith("test_results_"))
+    merged = list(iter_test_results(os.path.join(output_dir, results_file)))
+    assert [item["test_id"] for item in merged] == [1, 2, 3]
+    assert merged[2]["chat_history"] == record(3)["chat_history"]
@@ -0,0 +1,38 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 导入框架只创建代理，不连接模型；配置需要三项（llm_config 与 llm_config2）
+@pytest.fixture
+def framework(tmp_path, monkeypatch):
+    config = tmp_path / "config.json"
+    config.write_text(json.dumps([{"model": "llama3.1", "api_type": "ollama"}] * 3), encoding="utf-8")
+    monkeypatch.setenv("QAI_CONFIG_LIST", str(config))
+    module = pytest.importorskip("读取数据集用框架")
+    monkeypatch.setattr(module, "prompt_version_cache", None)
+    return module
+
+def checkpoint_key(framework):
+    framework.prompt_version_cache = None
+    return framework.round_checkpoint_key("case", 1, "任务", [])
+
+@pytest.mark.parametrize("change", [
+    lambda fw, mp: mp.setitem(fw.call_policies, "default", {**fw.call_policies["default"], "num_ctx": 2048}),
+    lambda fw, mp: mp.setitem(fw.call_policies, "evaluator", {**fw.call_policies.get("evaluator", {}), "think_budget": 0}),
+    lambda fw, mp: mp.setattr(fw, "structured_output", not fw.structured_output),
+    lambda fw, mp: mp.setitem(fw.model_routes, "evaluator", {"fallback": "llama3.2:1b"}),
+    lambda fw, mp: mp.setattr(fw, "prompt_variant", "compact"),
+])
+def test_output_settings_change_checkpoint_key(framework, monkeypatch, change):
+    before = checkpoint_key(framework)
+    change(framework, monkeypatch)
+    assert checkpoint_key(framework) != before
+
+def test_runtime_policy_keeps_checkpoint_key(framework, monkeypatch):
+    before = checkpoint_key(framework)
+    monkeypatch.setitem(framework.call_policies, "default", {**framework.call_policies["default"], "timeout": 999, "retries": 9})
+    assert checkpoint_key(framework) == before
@@ -0,0 +1,319 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+# 分布式任务队列：多个进程或多台机器从同一个队列领取对话，各自调用自己的后端，结果写入各自的分片文件。
+# FileWorkQueue 基于共享目录，领取、完成和回收都通过原子 rename 完成；SQLiteWorkQueue 用于单机多进程测试。
+# 租约超过 lease_seconds 未续期的任务视为所属 worker 已失效，由其他 worker 重新领取；初始化标记同样超过 lease_seconds 未刷新时由其他 worker 接手初始化。
+# 处理出错的任务放回队列重试，累计 max_attempts 次出错后才标记为失败。
+# 本模块不依赖 autogen
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+# 共享目录队列：pending/ 待处理，leased/ 已领取（文件修改时间即最近一次续租时间），done/ 已完成，failed/ 处理出错。
+# 领取时 leased/ 中的文件名带上本次领取的随机令牌（<序号>.<令牌>.json），续租、完成和出错只操作自己领取的文件；
+# 租约过期后任务被其他 worker 重新领取时，原 worker 的这些操作不再生效
+class FileWorkQueue:
+    def __init__(self, path, lease_seconds=600, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.held = {}
+        self.lock = threading.Lock()
+        for state in ("pending", "leased", "done", "failed"):
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def _file(self, state, idx):
+        return os.path.join(self.path, state, f"{idx:08d}.json")
+
+    def is_ready(self):
+        return os.path.exists(os.path.join(self.path, "READY"))
+
+    # 只有一个进程能创建 INIT 标记并负责写入任务；INIT 的修改时间超过 lease_seconds 未刷新时，
+    # 视为初始化进程已崩溃，先把旧标记改名移走（只有一个进程能成功）再重新创建
+    def try_begin_init(self):
+        init = os.path.join(self.path, "INIT")
+        try:
+            os.close(os.open(init, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - os.path.getmtime(init) <= self.lease_seconds:
+                return False
+            stale = os.path.join(self.path, f".INIT.stale_{default_worker_id()}")
+            os.rename(init, stale)
+            os.remove(stale)
+        except FileNotFoundError:
+            return False
+        print("任务队列初始化标记已过期，接手初始化")
+        return self.try_begin_init()
+
+    def refresh_init(self):
+        os.utime(os.path.join(self.path, "INIT"))
+
+    # 重新初始化时已写入的任务被相同内容覆盖
+    def enqueue_all(self, items):
+        count = 0
+        refreshed = time.time()
+        for idx, name, dialogue in items:
+            tmp = os.path.join(self.path, f".enqueue_{idx:08d}.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"idx": idx, "name": name, "dialogue": dialogue}, f, ensure_ascii=False)
+            os.rename(tmp, self._file("pending", idx))
+            count += 1
+            if time.time() - refreshed > self.lease_seconds / 3:
+                self.refresh_init()
+                refreshed = time.time()
+        return count
+
+    def mark_ready(self):
+        with open(os.path.join(self.path, "READY"), "w", encoding="utf-8") as f:
+            f.write(str(time.time()))
+
+    def claim(self, worker_id):
+        self.requeue_expired()
+        for entry in sorted(os.listdir(os.path.join(self.path, "pending"))):
+            pending = os.path.join(self.path, "pending", entry)
+            leased = os.path.join(self.path, "leased", f"{entry.split('.')[0]}.{uuid.uuid4().hex[:12]}.json")
+            try:
+                os.utime(pending)
+                os.rename(pending, leased)
+                with open(leased, "r", encoding="utf-8") as f:
+                    task = json.load(f)
+            except FileNotFoundError:
+                continue
+            with self.lock:
+                self.held[task["idx"]] = leased
+            return task
+        return None
+
+    def renew_held(self):
+        with self.lock:
+            held = list(self.held.items())
+        for idx, leased in held:
+            try:
+                os.utime(leased)
+            except FileNotFoundError:
+                with self.lock:
+                    if self.held.get(idx) == leased:
+                        del self.held[idx]
+
+    def requeue_expired(self):
+        now = time.time()
+        for entry in os.listdir(os.path.join(self.path, "leased")):
+            leased = os.path.join(self.path, "leased", entry)
+            try:
+                if now - os.path.getmtime(leased) > self.lease_seconds:
+                    os.rename(leased, os.path.join(self.path, "pending", f"{entry.split('.')[0]}.json"))
+                    print(f"任务 {entry} 租约过期，重新放回队列")
+            except FileNotFoundError:
+                continue
+
+    def _release(self, idx):
+        with self.lock:
+            return self.held.pop(idx, None)
+
+    # 租约过期后任务可能已被放回 pending 但尚无人领取，此时同样移入 done，避免重复处理；已被其他 worker 领取时不动
+    def complete(self, idx):
+        leased = self._release(idx)
+        for source in ([leased] if leased else []) + [self._file("pending", idx)]:
+            try:
+                os.rename(source, self._file("done", idx))
+                return
+            except FileNotFoundError:
+                continue
+
+    # 先把自己领取的任务文件改名为本进程的临时文件，再写入出错次数，放回 pending 或移入 failed；
+    # 租约已失效时不动，出错次数不计入其他 worker 的领取
+    def fail(self, idx):
+        leased = self._release(idx)
+        if leased is None:
+            return
+        tmp = os.path.join(self.path, f".fail_{idx:08d}_{os.getpid()}.tmp")
+        try:
+            os.rename(leased, tmp)
+        except FileNotFoundError:
+            return
+        with open(tmp, "r", encoding="utf-8") as f:
+            task = json.load(f)
+        task["attempts"] = task.get("attempts", 0) + 1
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(task, f, ensure_ascii=False)
+        if task["attempts"] < self.max_attempts:
+            os.rename(tmp, self._file("pending", idx))
+            print(f"任务 {idx} 第 {task['attempts']} 次处理出错，重新放回队列")
+        else:
+            os.rename(tmp, self._file("failed", idx))
+
+    def failed_tasks(self):
+        return sorted(int(entry.split(".")[0]) for entry in os.listdir(os.path.join(self.path, "failed")))
+
+    def stats(self):
+        return {state: len(os.listdir(os.path.join(self.path, state))) for state in ("pending", "leased", "done", "failed")}
+
+# 单机 SQLite 队列：领取时在 IMMEDIATE 事务中选取待处理或租约已过期的任务
+class SQLiteWorkQueue:
+    def __init__(self, path, lease_seconds=600, max_attempts=3):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.held = set()
+        self.worker_id = None
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tasks (idx INTEGER PRIMARY KEY, name TEXT, payload TEXT, status TEXT DEFAULT 'pending', worker TEXT, lease_until REAL, attempts INTEGER DEFAULT 0)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # 旧版本创建的队列没有 attempts 列
+        if "attempts" not in {row[1] for row in self.db.execute("PRAGMA table_info(tasks)")}:
+            try:
+                self.db.execute("ALTER TABLE tasks ADD COLUMN attempts INTEGER DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass
+
+    def is_ready(self):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM meta WHERE key = 'ready'").fetchone() is not None
+
+    # meta 中 init 的值为最近一次刷新时间，超过 lease_seconds 未刷新时由本进程接手初始化
+    def try_begin_init(self):
+        now = time.time()
+        with self.lock:
+            if self.db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('init', ?)", (str(now),)).rowcount == 1:
+                return True
+            taken = self.db.execute("UPDATE meta SET value = ? WHERE key = 'init' AND CAST(value AS REAL) < ?", (str(now), now - self.lease_seconds)).rowcount == 1
+        if taken:
+            print("任务队列初始化标记已过期，接手初始化")
+        return taken
+
+    # 每隔 lease_seconds / 3 刷新 init 并提交一次，让其他进程看到初始化仍在进行
+    def enqueue_all(self, items):
+        count = 0
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                refreshed = time.time()
+                for idx, name, dialogue in items:
+                    self.db.execute("INSERT OR IGNORE INTO tasks (idx, name, payload) VALUES (?, ?, ?)", (idx, name, json.dumps(dialogue, ensure_ascii=False)))
+                    count += 1
+                    if time.time() - refreshed > self.lease_seconds / 3:
+                        refreshed = time.time()
+                        self.db.execute("UPDATE meta SET value = ? WHERE key = 'init'", (str(refreshed),))
+                        self.db.execute("COMMIT")
+                        self.db.execute("BEGIN IMMEDIATE")
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return count
+
+    def mark_ready(self):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('ready', ?)", (str(time.time()),))
+
+    def claim(self, worker_id):
+        now = time.time()
+        with self.lock:
+            self.worker_id = worker_id
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT idx, name, payload, status FROM tasks WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?) ORDER BY idx LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row:
+                    self.db.execute("UPDATE tasks SET status = 'leased', worker = ?, lease_until = ? WHERE idx = ?", (worker_id, now + self.lease_seconds, row[0]))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            if row is None:
+                return None
+            if row[3] == "leased":
+                print(f"任务 {row[0]} 租约过期，重新领取")
+            self.held.add(row[0])
+            return {"idx": row[0], "name": row[1], "dialogue": json.loads(row[2])}
+
+    def renew_held(self):
+        with self.lock:
+            for idx in list(self.held):
+                self.db.execute("UPDATE tasks SET lease_until = ? WHERE idx = ? AND status = 'leased' AND worker = ?", (time.time() + self.lease_seconds, idx, self.worker_id))
+
+    # 完成和出错只更新仍由本 worker 持有的任务；租约过期后被其他 worker 重新领取的任务不动
+    def complete(self, idx):
+        with self.lock:
+            self.held.discard(idx)
+            self.db.execute("UPDATE tasks SET status = 'done', lease_until = NULL WHERE idx = ? AND status = 'leased' AND worker = ?", (idx, self.worker_id))
+
+    def fail(self, idx):
+        with self.lock:
+            self.held.discard(idx)
+            updated = self.db.execute(
+                "UPDATE tasks SET attempts = attempts + 1, status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END, lease_until = NULL WHERE idx = ? AND status = 'leased' AND worker = ?",
+                (self.max_attempts, idx, self.worker_id)
+            ).rowcount
+            row = self.db.execute("SELECT status, attempts FROM tasks WHERE idx = ?", (idx,)).fetchone()
+        if updated and row[0] == "pending":
+            print(f"任务 {idx} 第 {row[1]} 次处理出错，重新放回队列")
+
+    def failed_tasks(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT idx FROM tasks WHERE status = 'failed' ORDER BY idx")]
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in ("pending", "leased", "done", "failed")}
+
+# 目录按共享目录队列打开，.db / .sqlite 文件按 SQLite 队列打开
+def open_work_queue(path, lease_seconds=600, max_attempts=3):
+    if path.endswith((".db", ".sqlite", ".sqlite3")):
+        return SQLiteWorkQueue(path, lease_seconds, max_attempts)
+    return FileWorkQueue(path, lease_seconds, max_attempts)
+
+# 第一个进程从数据源写入全部任务，其余进程等待队列就绪；等待期间初始化进程崩溃时，带有数据源的进程接手初始化
+def init_work_queue(work_queue, items=None, poll_seconds=2):
+    waiting = False
+    while not work_queue.is_ready():
+        if items is not None and work_queue.try_begin_init():
+            count = work_queue.enqueue_all(items)
+            work_queue.mark_ready()
+            print(f"任务队列初始化完成，共 {count} 条对话")
+            return
+        if not waiting:
+            print("等待任务队列初始化……")
+            waiting = True
+        time.sleep(poll_seconds)
+
+# 后台定期为本进程持有的任务续租
+def start_lease_heartbeat(work_queue):
+    def beat():
+        while True:
+            time.sleep(max(1, work_queue.lease_seconds / 3))
+            try:
+                work_queue.renew_held()
+            except Exception as e:
+                print(f"续租出错: {e}")
+    threading.Thread(target=beat, daemon=True).start()
+
+# 逐条领取任务，产生 (序号, 名称, 对话)；队列暂空但仍有其他 worker 持有的任务时等待，以便接手过期租约。
+# slots 为并发槽位（BoundedSemaphore）时先占用一个槽位再领取，槽位由调用方在任务处理完后释放，领到的任务不会闲置占用租约
+def iter_claims(work_queue, worker_id, poll_seconds=5, slots=None):
+    while True:
+        if slots:
+            slots.acquire()
+        task = work_queue.claim(worker_id)
+        if task is not None:
+            yield task["idx"], task["name"], task["dialogue"]
+            continue
+        if slots:
+            slots.release()
+        stats = work_queue.stats()
+        if not stats["pending"] and not stats["leased"]:
+            return
+        time.sleep(poll_seconds)
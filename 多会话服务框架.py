@@ -0,0 +1,520 @@
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web, WSMsgType
+
+# 框架模块在解析参数后导入：mock 模式需要先写入配置文件路径
+framework = None
+
+# 新建会话状态：对应交互框架中的 conversation_history、selector_state 和 all_chat_history
+def new_session(session_id):
+    now = time.time()
+    return {
+        "session_id": session_id,
+        "round_num": 1,
+        "conversation_history": [],
+        "selector_state": {"last_selected_genres": [], "inactive_rounds": 0, "selector_active": True},
+        "chat_history": {},
+        "created_at": now,
+        "last_active": now
+    }
+
+# 会话存储：内存中按最近使用顺序保留会话，总大小超过上限或空闲超时的会话压缩写入 SQLite，访问时再恢复。
+# 正在运行轮次的会话被固定（pin），不会被换出；换出时优先选择最久未使用的会话
+class SessionStore:
+    def __init__(self, db_path, memory_limit_bytes, idle_seconds):
+        self.hot = OrderedDict()
+        self.sizes = {}
+        self.pins = {}
+        self.memory_limit_bytes = memory_limit_bytes
+        self.idle_seconds = idle_seconds
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, data BLOB, spilled_at REAL)")
+        self.db.commit()
+        self.on_spill = None
+
+    def memory_bytes(self):
+        with self.lock:
+            return sum(self.sizes.values())
+
+    def spilled_count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def stats(self):
+        return {
+            "hot_sessions": len(self.hot),
+            "spilled_sessions": self.spilled_count(),
+            "memory_bytes": self.memory_bytes(),
+            "memory_limit_bytes": self.memory_limit_bytes,
+            "pinned_sessions": len(self.pins)
+        }
+
+    def __len__(self):
+        with self.lock:
+            return len(self.hot) + self.spilled_count()
+
+    def add(self, session):
+        with self.lock:
+            self.hot[session["session_id"]] = session
+            self.sizes[session["session_id"]] = estimate_session_size(session)
+            self.evict()
+
+    def get(self, session_id):
+        with self.lock:
+            if session_id in self.hot:
+                self.hot.move_to_end(session_id)
+                return self.hot[session_id]
+            return self.restore(session_id)
+
+    # 一轮结束后重新计算会话大小，必要时换出其他会话
+    def touch(self, session_id):
+        with self.lock:
+            if session_id in self.hot:
+                self.hot.move_to_end(session_id)
+                self.sizes[session_id] = estimate_session_size(self.hot[session_id])
+                framework.observe_metric("session_store.session_bytes", self.sizes[session_id])
+                self.evict()
+
+    def pin(self, session_id):
+        with self.lock:
+            session = self.get(session_id)
+            if session is not None:
+                self.pins[session_id] = self.pins.get(session_id, 0) + 1
+            return session
+
+    def unpin(self, session_id):
+        with self.lock:
+            if self.pins.get(session_id, 0) <= 1:
+                self.pins.pop(session_id, None)
+            else:
+                self.pins[session_id] -= 1
+
+    def delete(self, session_id):
+        with self.lock:
+            session = self.get(session_id)
+            self.hot.pop(session_id, None)
+            self.sizes.pop(session_id, None)
+            self.db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self.db.commit()
+            return session
+
+    def spill(self, session_id):
+        start = time.monotonic()
+        session = self.hot.pop(session_id)
+        size = self.sizes.pop(session_id, 0)
+        data = zlib.compress(json.dumps(session, ensure_ascii=False).encode("utf-8"))
+        self.db.execute("INSERT OR REPLACE INTO sessions (session_id, data, spilled_at) VALUES (?, ?, ?)", (session_id, data, time.time()))
+        self.db.commit()
+        if self.on_spill:
+            self.on_spill(session_id)
+        framework.observe_metric("session_store.spill_seconds", time.monotonic() - start)
+        framework.count_metric("session_store.spill")
+        framework.count_metric("session_store.spill_bytes", size)
+
+    def restore(self, session_id):
+        start = time.monotonic()
+        row = self.db.execute("SELECT data FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        session = json.loads(zlib.decompress(row[0]).decode("utf-8"))
+        self.db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        self.db.commit()
+        self.hot[session_id] = session
+        self.sizes[session_id] = estimate_session_size(session)
+        framework.observe_metric("session_store.restore_seconds", time.monotonic() - start)
+        framework.count_metric("session_store.restore")
+        self.evict(keep=session_id)
+        return session
+
+    # 超过内存上限时，从最久未使用的一端换出未固定的会话
+    def evict(self, keep=None):
+        while sum(self.sizes.values()) > self.memory_limit_bytes:
+            victim = next((sid for sid in self.hot if sid not in self.pins and sid != keep), None)
+            if victim is None:
+                break
+            self.spill(victim)
+
+    # 换出空闲超过 idle_seconds 的会话，使其不占用活跃会话的内存
+    def spill_idle(self):
+        now = time.time()
+        with self.lock:
+            idle = [sid for sid, session in self.hot.items() if sid not in self.pins and now - session["last_active"] > self.idle_seconds]
+            for session_id in idle:
+                self.spill(session_id)
+        return len(idle)
+
+def estimate_session_size(session):
+    return len(json.dumps(session, ensure_ascii=False).encode("utf-8"))
+
+# 会话存储的 SQLite 读写和压缩在单独的线程中执行，换出或恢复会话时不阻塞事件循环上的其他会话
+async def run_store(app, func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app["store_executor"], functools.partial(func, *args))
+
+async def get_session(app, session_id):
+    session = await run_store(app, app["store"].get, session_id)
+    if session is None:
+        raise web.HTTPNotFound(text=json.dumps({"error": f"会话 {session_id} 不存在"}, ensure_ascii=False), content_type="application/json")
+    return session
+
+def get_runtime(app, session_id):
+    runtime = app["runtime"].get(session_id)
+    if runtime is None:
+        runtime = {"agents": framework.new_session_agents(), "lock": asyncio.Lock()}
+        app["runtime"][session_id] = runtime
+    return runtime
+
+async def create_session(app):
+    session = new_session(uuid.uuid4().hex)
+    await run_store(app, app["store"].add, session)
+    return session
+
+# 会话被换出时释放其发送方代理，恢复后按需重新创建
+def drop_runtime(app, session_id):
+    runtime = app["runtime"].pop(session_id, None)
+    if runtime:
+        framework.release_session_agents(runtime["agents"])
+
+async def close_session(app, session_id):
+    await get_session(app, session_id)
+    session = await run_store(app, app["store"].delete, session_id)
+    drop_runtime(app, session_id)
+    if app["output_dir"]:
+        await run_store(app, save_session, app["output_dir"], session_id, session)
+
+def save_session(output_dir, session_id, session):
+    try:
+        with open(os.path.join(output_dir, f"session_{session_id}.json"), "w", encoding="utf-8") as f:
+            json.dump(session, f, ensure_ascii=False, indent=4)
+    except Exception as e:
+        print(f"保存会话 {session_id} 出错: {e}")
+
+def bad_request(error):
+    return web.HTTPBadRequest(text=json.dumps({"error": error}, ensure_ascii=False), content_type="application/json")
+
+# 校验一轮请求：须为 JSON 对象，task 为字符串，round_budget 为非负数或省略
+def parse_round_request(payload):
+    if not isinstance(payload, dict):
+        raise bad_request("请求体必须是 JSON 对象")
+    task, round_budget = payload.get("task"), payload.get("round_budget")
+    if not isinstance(task, str):
+        raise bad_request("task 必须是字符串")
+    if round_budget is not None and (isinstance(round_budget, bool) or not isinstance(round_budget, (int, float)) or round_budget < 0):
+        raise bad_request("round_budget 必须是非负数")
+    return task, round_budget
+
+# 在线程池中运行一轮完整流程；同一会话的轮次串行，不同会话并发
+async def run_session_round(app, session_id, task, round_budget=None):
+    task = framework.clean_text(task or "")
+    if not task.strip():
+        raise bad_request("任务为空或仅含非法字符")
+    if await run_store(app, app["store"].pin, session_id) is None:
+        await get_session(app, session_id)
+    try:
+        return await run_pinned_round(app, session_id, task, round_budget)
+    finally:
+        await run_store(app, app["store"].unpin, session_id)
+
+async def run_pinned_round(app, session_id, task, round_budget):
+    runtime = get_runtime(app, session_id)
+    async with runtime["lock"]:
+        session = await get_session(app, session_id)
+        round_num = session["round_num"]
+        round_chat_history = {}
+        loop = asyncio.get_running_loop()
+        final_result = await loop.run_in_executor(
+            app["executor"],
+            functools.partial(
+                framework.run_round,
+                task,
+                round_num,
+                round_chat_history,
+                session["conversation_history"],
+                session["selector_state"],
+                round_budget=round_budget if round_budget is not None else app["round_budget"],
+                agents=runtime["agents"]
+            )
+        )
+        session["conversation_history"].append({"task": task, "result": final_result})
+        session["chat_history"][f"round_{round_num}"] = round_chat_history
+        session["round_num"] = round_num + 1
+        session["last_active"] = time.time()
+        await run_store(app, app["store"].touch, session_id)
+    return {
+        "session_id": session_id,
+        "round": round_num,
+        "final_result": final_result,
+        "cut_stage": round_chat_history.get("budget", {}).get("cut_stage")
+    }
+
+def json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+async def handle_create_session(request):
+    session = await create_session(request.app)
+    return json_response({"session_id": session["session_id"]}, status=201)
+
+async def handle_get_session(request):
+    session = await get_session(request.app, request.match_info["session_id"])
+    data = {key: value for key, value in session.items() if key != "chat_history"}
+    if request.query.get("full"):
+        data["chat_history"] = session["chat_history"]
+    return json_response(data)
+
+async def handle_delete_session(request):
+    await close_session(request.app, request.match_info["session_id"])
+    return json_response({"deleted": request.match_info["session_id"]})
+
+async def handle_round(request):
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise bad_request("请求体必须是 JSON")
+    task, round_budget = parse_round_request(body)
+    result = await run_session_round(request.app, request.match_info["session_id"], task, round_budget)
+    return json_response(result)
+
+# WebSocket：每条消息为一个任务（纯文本或 {"task": ..., "round_budget": ...}），逐轮返回结果
+async def handle_websocket(request):
+    session_id = request.match_info["session_id"]
+    await get_session(request.app, session_id)
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    async for msg in ws:
+        if msg.type != WSMsgType.TEXT:
+            continue
+        if msg.data.strip().lower() == "exit":
+            break
+        try:
+            payload = json.loads(msg.data) if msg.data.lstrip().startswith("{") else {"task": msg.data}
+            task, round_budget = parse_round_request(payload)
+            result = await run_session_round(request.app, session_id, task, round_budget)
+        except json.JSONDecodeError:
+            result = {"error": "消息必须是纯文本或 JSON 对象"}
+        except web.HTTPException as e:
+            result = {"error": e.text}
+        except Exception as e:
+            result = {"error": f"本轮运行出错: {e}"}
+        await ws.send_str(json.dumps(result, ensure_ascii=False))
+    await ws.close()
+    return ws
+
+async def handle_metrics(request):
+    store = request.app["store"]
+    sessions, store_stats = await run_store(request.app, lambda: (len(store), store.stats()))
+    return json_response({"sessions": sessions, "session_store": store_stats, "scheduler": framework.model_scheduler.stats(), "backends": framework.backend_pool_stats(), "near_cache": framework.near_cache.stats() if framework.near_cache else None, **framework.metrics_summary()})
+
+# 后台定期换出空闲会话
+async def idle_sweeper(app):
+    while True:
+        await asyncio.sleep(app["sweep_interval"])
+        try:
+            spilled = await run_store(app, app["store"].spill_idle)
+            if spilled:
+                print(f"换出 {spilled} 个空闲会话")
+        except Exception as e:
+            print(f"换出空闲会话出错: {e}")
+
+async def start_background_tasks(app):
+    app["sweeper"] = asyncio.create_task(idle_sweeper(app))
+
+async def stop_background_tasks(app):
+    app["sweeper"].cancel()
+
+def create_app(round_budget=None, max_concurrent_rounds=8, output_dir=None, session_db=None, session_memory_mb=256, session_idle_seconds=600):
+    app = web.Application()
+    app["store"] = SessionStore(session_db or os.path.join(tempfile.gettempdir(), "counseling_sessions.db"), int(session_memory_mb * 1024 * 1024), session_idle_seconds)
+    app["store"].on_spill = lambda session_id: drop_runtime(app, session_id)
+    app["sweep_interval"] = max(1, min(60, session_idle_seconds / 2))
+    app["runtime"] = {}
+    app["round_budget"] = round_budget
+    app["output_dir"] = output_dir
+    app["executor"] = ThreadPoolExecutor(max_workers=max_concurrent_rounds)
+    app["store_executor"] = ThreadPoolExecutor(max_workers=1)
+    app.router.add_post("/sessions", handle_create_session)
+    app.router.add_get("/sessions/{session_id}", handle_get_session)
+    app.router.add_delete("/sessions/{session_id}", handle_delete_session)
+    app.router.add_post("/sessions/{session_id}/rounds", handle_round)
+    app.router.add_get("/sessions/{session_id}/ws", handle_websocket)
+    app.router.add_get("/metrics", handle_metrics)
+    app.on_startup.append(start_background_tasks)
+    app.on_cleanup.append(stop_background_tasks)
+    return app
+
+# 本地模拟后端：实现 Ollama /api/chat，按系统提示返回固定格式的回复，用于无模型环境下测试服务；
+# 另实现预热用的 /api/generate（每个模型第一次请求报告 load_duration，模拟冷加载）和健康检查用的 /api/tags
+mock_models = ["deepseek-r1:1.5b", "llama3.1"]
+
+def mock_reply(messages):
+    system = next((msg["content"] for msg in messages if msg.get("role") == "system"), "")
+    if "心理疗法整合专家" in system:
+        return "听起来这段时间你承受了很多，我们可以先看看让你最难受的那个想法，再一起找一个小小的改变。"
+    if "格式：'评分：X.X分" in system:
+        return f"评分：{random.choice([3.5, 4.0, 4.5])}分\n修改意见：表述清晰，可以更贴近来访者的具体情境。"
+    if "心理咨询流派中选择" in system:
+        return "认知行为疗法、人本主义疗法。"
+    return "<think>先共情，再了解具体情况。</think>谢谢你愿意说出来，能多讲讲最近让你最困扰的事情吗？"
+
+async def handle_mock_chat(request):
+    body = await request.json()
+    await asyncio.sleep(request.app["mock_delay"])
+    content = mock_reply(body.get("messages", []))
+    created_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    stats = {"prompt_eval_count": sum(len(msg.get("content", "")) for msg in body.get("messages", [])), "eval_count": len(content)}
+    if not body.get("stream"):
+        return web.json_response({"model": body.get("model"), "created_at": created_at, "message": {"role": "assistant", "content": content}, "done": True, "done_reason": "stop", **stats})
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    for i in range(0, len(content), 4):
+        chunk = {"model": body.get("model"), "created_at": created_at, "message": {"role": "assistant", "content": content[i:i + 4]}, "done": False}
+        await response.write((json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8"))
+    final = {"model": body.get("model"), "created_at": created_at, "message": {"role": "assistant", "content": ""}, "done": True, "done_reason": "stop", **stats}
+    await response.write((json.dumps(final, ensure_ascii=False) + "\n").encode("utf-8"))
+    await response.write_eof()
+    return response
+
+async def handle_mock_generate(request):
+    body = await request.json()
+    await asyncio.sleep(request.app["mock_delay"])
+    model, prompt = body.get("model"), body.get("prompt") or ""
+    cold = model not in request.app["mock_loaded"]
+    request.app["mock_loaded"].add(model)
+    content = mock_reply([{"role": "user", "content": prompt}]) if prompt else ""
+    return web.json_response({
+        "model": model,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "response": content,
+        "done": True,
+        "done_reason": "stop" if prompt else "load",
+        "load_duration": int(request.app["mock_delay"] * 1e9) if cold else 0,
+        "prompt_eval_count": len(prompt),
+        "eval_count": len(content)
+    }, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+async def handle_mock_tags(request):
+    return web.json_response({"models": [{"name": model, "model": model} for model in mock_models]})
+
+def create_mock_app(delay=0.05):
+    app = web.Application()
+    app["mock_delay"] = delay
+    app["mock_loaded"] = set()
+    app.router.add_post("/api/chat", handle_mock_chat)
+    app.router.add_post("/api/generate", handle_mock_generate)
+    app.router.add_get("/api/tags", handle_mock_tags)
+    return app
+
+# 写入指向模拟后端的配置文件（三项，对应 llm_config 与 llm_config2 的取值）
+def write_mock_config(port):
+    base_url = f"http://127.0.0.1:{port}"
+    entries = [
+        {"model": mock_models[0], "model_client_cls": "CustomOllamaClient", "base_url": base_url},
+        {"model": mock_models[1], "model_client_cls": "CustomOllamaClient", "base_url": base_url},
+        {"model": mock_models[1], "model_client_cls": "CustomOllamaClient", "base_url": base_url}
+    ]
+    fd, path = tempfile.mkstemp(prefix="mock_config_", suffix=".json")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(entries, f, ensure_ascii=False, indent=4)
+    return path
+
+async def serve(args):
+    runners = []
+    if args.mock_backend:
+        mock_runner = web.AppRunner(create_mock_app(args.mock_delay))
+        await mock_runner.setup()
+        await web.TCPSite(mock_runner, "127.0.0.1", args.mock_port).start()
+        runners.append(mock_runner)
+        print(f"模拟后端已启动: http://127.0.0.1:{args.mock_port}")
+    # 预热在模拟后端启动之后、开始接受请求之前进行
+    if args.warmup or args.warmup_prefill:
+        await asyncio.get_running_loop().run_in_executor(None, functools.partial(framework.warmup_models, prefill=args.warmup_prefill))
+    runner = web.AppRunner(create_app(args.round_budget, args.max_concurrent_rounds, args.output_dir, args.session_db, args.session_memory_mb, args.session_idle_seconds))
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    runners.append(runner)
+    print(f"多会话服务已启动: http://{args.host}:{args.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+def main():
+    global framework
+    parser = argparse.ArgumentParser(description="Serve the counseling round pipeline to many concurrent sessions over HTTP/WebSocket")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help="Address to bind")
+    parser.add_argument('--port', type=int, default=8080, help="Port to bind")
+    parser.add_argument('--config', type=str, default=None, help="Path to the model config list (overrides QAI_CONFIG_LIST)")
+    parser.add_argument('--round_budget', type=float, default=None, help="Default per-round latency budget in seconds")
+    parser.add_argument('--max_concurrent_rounds', type=int, default=8, help="Rounds that may run at the same time across sessions")
+    parser.add_argument('--output_dir', type=str, default=None, help="Directory where closed sessions are saved")
+    parser.add_argument('--session_db', type=str, default=None, help="SQLite file that idle or evicted sessions are spilled to")
+    parser.add_argument('--session_memory_mb', type=float, default=256, help="Memory cap for sessions kept in memory, in MB")
+    parser.add_argument('--session_idle_seconds', type=float, default=600, help="Sessions idle longer than this are spilled to disk")
+    parser.add_argument('--call_policy', type=str, default=None, help="JSON file overriding per-role timeout/retries/backoff")
+    parser.add_argument('--structured_output', action='store_true', help="Constrain selector and evaluator output with a JSON schema and send a short repair prompt on format violations")
+    parser.add_argument('--warmup', action='store_true', help="Load every configured model on all its backends concurrently before the first round and report cold-load time")
+    parser.add_argument('--warmup_prefill', action='store_true', help="Warm up and also prefill each model with its longest static system prompt")
+    parser.add_argument('--keep_alive', type=str, default=None, help="Ollama keep_alive sent with warm-up and every CustomOllamaClient call, e.g. -1 to keep models loaded for the run")
+    parser.add_argument('--near_cache_threshold', type=float, default=None, help="Serve early rounds from a near-duplicate earlier round when the MinHash similarity of task and history reaches this threshold (e.g. 0.6)")
+    parser.add_argument('--near_cache_rounds', type=int, default=2, help="Only rounds up to this number use the near-duplicate cache")
+    parser.add_argument('--num_ctx', type=int, default=None, help="Context length (tokens) passed to Ollama as num_ctx; older conversation history is trimmed to fit it")
+    parser.add_argument('--prompt_variant', type=str, default="full", choices=["full", "compact"], help="System prompt variant: the full prompts, or compact ones without examples and duplicated boilerplate")
+    parser.add_argument('--model_routes', type=str, default=None, help="JSON file mapping roles to primary/fallback models (and optional downgrade thresholds)")
+    parser.add_argument('--batch_window_ms', type=float, default=0, help="How long genre/evaluator requests wait to be batched across sessions, e.g. 5; 0 (default) disables batching")
+    parser.add_argument('--batch_size', type=int, default=8, help="Maximum requests per batch")
+    parser.add_argument('--batch_slots', type=int, default=8, help="Parallel request slots the backend serves")
+    parser.add_argument('--model_concurrency', type=int, default=0, help="Maximum in-flight requests per backend model, for models whose config entry sets no max_concurrency; 0 means unlimited")
+    parser.add_argument('--speculative_general', action='store_true', help="Start the general agent alongside the selector and genre stages and only wait for it when a fallback needs its text")
+    parser.add_argument('--serial_integration_eval', action='store_true', help="Run integration evaluators one after another, each seeing the previous evaluators' output as carryover context")
+    parser.add_argument('--mock_backend', action='store_true', help="Start a local mock Ollama backend and point every agent at it")
+    parser.add_argument('--mock_port', type=int, default=11435, help="Port of the mock backend")
+    parser.add_argument('--mock_delay', type=float, default=0.05, help="Simulated latency of each mock model call in seconds")
+    args = parser.parse_args()
+
+    if args.mock_backend:
+        os.environ["QAI_CONFIG_LIST"] = write_mock_config(args.mock_port)
+    elif args.config:
+        os.environ["QAI_CONFIG_LIST"] = args.config
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    import 实时输入对话内容框架 as framework_module
+    framework = framework_module
+    if args.call_policy:
+        framework.load_call_policies(args.call_policy)
+    if args.model_routes:
+        framework.load_model_routes(args.model_routes)
+    if args.prompt_variant != "full":
+        framework.apply_prompt_variant(args.prompt_variant)
+    if args.num_ctx:
+        framework.call_policies["default"]["num_ctx"] = args.num_ctx
+    if args.near_cache_threshold is not None:
+        framework.near_cache = framework.NearDuplicateCache(args.near_cache_threshold, max_rounds=args.near_cache_rounds)
+    framework.configure_request_batching(args.batch_window_ms, args.batch_size, args.batch_slots)
+    framework.configure_model_scheduler(args.model_concurrency)
+    framework.speculative_general = args.speculative_general
+    framework.parallel_integration_eval = not args.serial_integration_eval
+    framework.structured_output = args.structured_output
+    if args.keep_alive is not None:
+        framework.keep_alive = framework.parse_keep_alive(args.keep_alive)
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        print("服务已停止。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import json
+import re
+import time
+import uuid
+from collections import defaultdict
+from ollama import Client as OllamaClient
+import 读取数据集用框架 as framework
+
+# 提示词分析：对每个代理的系统提示词统计完整版（full）和精简版（compact）的 token 数，
+# token 数用目标模型自己的分词器计算（raw 模式生成 1 个 token，读取 Ollama 返回的 prompt_eval_count）；
+# 同时列出跨提示词重复的行（可提取为共用片段）、提示词内部重复的行和没有内容的段落。
+# --bench N 时每个提示词的两种版本各评估 N 次，对比 prompt eval 耗时。
+# 导入读取数据集用框架以取得全部代理，需要与运行框架相同的 QAI_CONFIG_LIST
+
+heading_pattern = re.compile(r'(\*\*[^*]+\*\*[:：]?|#{1,6} .*)$')
+min_shared_length = 12
+
+def agent_target(agent):
+    entry = agent.llm_config["config_list"][0]
+    host = entry.get("client_host") or entry.get("base_url") or "http://localhost:11434"
+    return entry.get("model"), host[:-len("/v1")] if host.endswith("/v1") else host
+
+# 每次在提示词前加随机前缀，避免命中 Ollama 的 KV 缓存；token 数减去只含前缀时的计数
+def evaluate_prompt(client, model, text):
+    response = client.generate(model=model, prompt=f"[{uuid.uuid4().hex[:8]}]\n{text}", raw=True, options={"num_predict": 1})
+    return response.get("prompt_eval_count") or 0, (response.get("prompt_eval_duration") or 0) / 1e6
+
+def count_tokens(client, model, text, baseline):
+    return evaluate_prompt(client, model, text)[0] - baseline
+
+def shared_lines(prompts):
+    owners = defaultdict(list)
+    for key, text in prompts.items():
+        for line in dict.fromkeys(line.strip() for line in text.splitlines()):
+            if len(line) >= min_shared_length:
+                owners[line].append(key)
+    shared = [(line, keys) for line, keys in owners.items() if len(keys) > 1]
+    shared.sort(key=lambda item: len(item[0]) * (len(item[1]) - 1), reverse=True)
+    return [{"line": line, "prompts": keys, "saved_chars": len(line) * (len(keys) - 1)} for line, keys in shared]
+
+def repeated_lines(text):
+    counts = defaultdict(int)
+    for line in text.splitlines():
+        if len(line.strip()) >= 8:
+            counts[line.strip()] += 1
+    return [line for line, count in counts.items() if count > 1]
+
+# 标题之后紧接着另一个标题或提示词结尾的段落
+def empty_sections(text):
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    return [line for line, following in zip(lines, lines[1:] + [None]) if heading_pattern.match(line) and (following is None or heading_pattern.match(following))]
+
+def analyze(bench=0, offline=False):
+    agents = framework.prompt_agents()
+    prompts = {key: agent.system_message for key, agent in agents.items()}
+    clients, baselines, report = {}, {}, {}
+    for key, agent in agents.items():
+        full = prompts[key]
+        compact = framework.compile_prompt(full, "compact")
+        entry = {
+            "chars": {"full": len(full), "compact": len(compact)},
+            "repeated_lines": repeated_lines(full),
+            "empty_sections": empty_sections(full)
+        }
+        if not offline:
+            model, host = agent_target(agent)
+            if host not in clients:
+                clients[host] = OllamaClient(host=host)
+            client = clients[host]
+            if (host, model) not in baselines:
+                baselines[(host, model)] = evaluate_prompt(client, model, "")[0]
+            baseline = baselines[(host, model)]
+            entry["model"] = model
+            entry["tokens"] = {"full": count_tokens(client, model, full, baseline), "compact": count_tokens(client, model, compact, baseline)}
+            if bench:
+                durations = {"full": [], "compact": []}
+                for _ in range(bench):
+                    for variant, text in (("full", full), ("compact", compact)):
+                        durations[variant].append(evaluate_prompt(client, model, text)[1])
+                entry["prompt_eval_ms"] = {variant: round(sum(values) / len(values), 2) for variant, values in durations.items()}
+        report[key] = entry
+    totals = {"chars": {variant: sum(entry["chars"][variant] for entry in report.values()) for variant in ("full", "compact")}}
+    if not offline:
+        totals["tokens"] = {variant: sum(entry["tokens"][variant] for entry in report.values()) for variant in ("full", "compact")}
+        if bench:
+            totals["prompt_eval_ms"] = {variant: round(sum(entry["prompt_eval_ms"][variant] for entry in report.values()), 2) for variant in ("full", "compact")}
+    return {"prompts": report, "totals": totals, "shared_lines": shared_lines(prompts)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure system prompt tokens, duplicated boilerplate and the compact prompt variant")
+    parser.add_argument('--bench', type=int, default=0, help="Evaluate each prompt N times per variant and compare prompt eval duration")
+    parser.add_argument('--offline', action='store_true', help="Only count characters and duplicates without calling the model tokenizer")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    result = analyze(bench=args.bench, offline=args.offline)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    print(json.dumps(result, ensure_ascii=False, indent=4))
@@ -0,0 +1,70 @@
+import gzip
+import io
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 测试结果文件读写：流式结果为 JSON Lines，每行一条对话记录，按扩展名选择 gzip（.gz）或 zstd（.zst）压缩；
+# 以 "a" 模式追加时写入新的压缩帧，读取时按顺序连续解压；
+# 记录中的 chat_history 可以是消息存储压缩格式，此时同一行的 "messages" 字段保存被引用的正文。
+# 写入进程被中途终止时文件末尾可能不完整（缺少 gzip 结尾或只写了半行），读取时保留之前的记录并给出警告。
+# 本模块不依赖 autogen，分析脚本可以直接导入
+
+def open_results_stream(path, mode="r"):
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("读写 .zst 文件需要安装 zstandard：pip install zstandard")
+        if mode in ("w", "a"):
+            return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, mode + "b")), encoding="utf-8")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True), encoding="utf-8")
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+# 文件末尾被截断或损坏时读取抛出的异常
+truncated_errors = (EOFError, zlib.error, ValueError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+def write_result_record(stream, record):
+    stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+    stream.flush()
+
+# 将 {"$ref": [摘要或 [短行原文], ...]} 引用还原为原文
+def expand_refs(obj, messages):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and "$ref" in obj:
+            return "\n".join(ref[0] if isinstance(ref, list) else messages[ref] for ref in obj["$ref"])
+        return {key: expand_refs(value, messages) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [expand_refs(value, messages) for value in obj]
+    return obj
+
+# 逐条读取流式结果文件，返回还原后的记录；expand=False 时保留压缩格式和 "messages" 字段
+def read_results_stream(path, expand=True):
+    count = 0
+    try:
+        with open_results_stream(path, "r") as stream:
+            for line in stream:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if expand and "messages" in record:
+                    record = expand_refs(record, record.pop("messages"))
+                count += 1
+                yield record
+    except truncated_errors as e:
+        print(f"警告：{path} 在第 {count} 条记录之后被截断或损坏（{e}），只保留之前的记录")
+
+# 读取任意格式的测试结果文件：.jsonl / .jsonl.gz / .jsonl.zst 流式读取，.json 支持原格式和 message_store_v1 格式
+def iter_test_results(path):
+    if not path.endswith(".json"):
+        yield from read_results_stream(path)
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        doc = json.load(f)
+    if isinstance(doc, dict) and doc.get("format") == "message_store_v1":
+        doc = expand_refs(doc["data"], doc["messages"])
+    yield from doc
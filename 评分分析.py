@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import re
+import time
+import numpy as np
+from 结果文件读写 import iter_test_results
+
+# 评分分析：把测试结果中的全部评估分数一次性抽取为列式表（NumPy 数组），缓存为结果文件旁的 .scores.npz，之后的统计均为向量化计算。
+# 分数表每行一个评分：对话 × 轮次 × 流派 × 指标 × 整合迭代（流派评估为 0，整合评估从 1 开始，流派记为 Integration）；
+# 轮次表每行一轮：所选流派（按 genres 顺序的位掩码）和整合迭代次数
+
+genres = ["CBT", "SFT", "PA", "NT", "HT", "General", "Integration"]
+metrics = ["TheoreticalCoherence", "GoalConsistency", "TechniqueCompatibility"]
+score_pattern = re.compile(r'评分[:：]?\s*(\d(?:\.\d)?)\s*(?:分)?\b', re.IGNORECASE)
+think_pattern = re.compile(r'<think>.*?</think>', re.DOTALL)
+cache_version = 1
+
+# 与框架中 extract_score 的规则一致（不打印日志）：超出 0-5 或无法提取时记 0 分
+def parse_score(text):
+    if not isinstance(text, str):
+        return 0.0
+    text = re.sub(r'[\n\r\t]+', ' ', think_pattern.sub('', text))
+    match = score_pattern.search(text)
+    if not match:
+        return 0.0
+    score = float(match.group(1))
+    return score if 0 <= score <= 5 else 0.0
+
+def build_tables(path):
+    scores = {"dialogue": [], "round": [], "genre": [], "metric": [], "iteration": [], "score": []}
+    rounds = {"dialogue": [], "round": [], "selected": [], "iterations": []}
+
+    def add_scores(dialogue, round_num, genre, iteration, transcripts):
+        for metric, transcript in enumerate(transcripts[:len(metrics)]):
+            if not transcript:
+                continue
+            for column, value in zip(scores, (dialogue, round_num, genre, metric, iteration, parse_score(transcript[-1].get("content")))):
+                scores[column].append(value)
+
+    for record in iter_test_results(path):
+        dialogue = record["test_id"]
+        for round_key, round_history in record["chat_history"].items():
+            if not round_key.startswith("round_"):
+                continue
+            round_num = int(round_key[len("round_"):])
+            selected, iterations = 0, 0
+            for key, value in round_history.items():
+                if key.startswith("genre_") and key[len("genre_"):] in genres:
+                    selected |= 1 << genres.index(key[len("genre_"):])
+                elif key.startswith("evaluator_"):
+                    genre = key[len("evaluator_"):]
+                    genre = genre[:-len("Agent")] if genre.endswith("Agent") else genre
+                    if genre in genres:
+                        add_scores(dialogue, round_num, genres.index(genre), 0, value)
+                elif key.startswith("integration_eval_iter_"):
+                    iteration = int(key[len("integration_eval_iter_"):])
+                    iterations = max(iterations, iteration)
+                    add_scores(dialogue, round_num, genres.index("Integration"), iteration, value)
+            for column, value in zip(rounds, (dialogue, round_num, selected, iterations)):
+                rounds[column].append(value)
+
+    score_table = {
+        "dialogue": np.array(scores["dialogue"], dtype=np.int32),
+        "round": np.array(scores["round"], dtype=np.int16),
+        "genre": np.array(scores["genre"], dtype=np.int8),
+        "metric": np.array(scores["metric"], dtype=np.int8),
+        "iteration": np.array(scores["iteration"], dtype=np.int8),
+        "score": np.array(scores["score"], dtype=np.float32)
+    }
+    round_table = {
+        "dialogue": np.array(rounds["dialogue"], dtype=np.int32),
+        "round": np.array(rounds["round"], dtype=np.int16),
+        "selected": np.array(rounds["selected"], dtype=np.int16),
+        "iterations": np.array(rounds["iterations"], dtype=np.int8)
+    }
+    return score_table, round_table
+
+# 读取分数表；缓存与结果文件的大小和修改时间一致时直接加载，否则重新抽取并写入缓存
+def load_tables(path, use_cache=True):
+    cache_path = path + ".scores.npz"
+    stat = os.stat(path)
+    source = np.array([cache_version, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    if use_cache and os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                if np.array_equal(cache["source"], source):
+                    return (
+                        {key[len("score_"):]: cache[key] for key in cache.files if key.startswith("score_")},
+                        {key[len("round_"):]: cache[key] for key in cache.files if key.startswith("round_")}
+                    )
+        except Exception as e:
+            print(f"读取缓存 {cache_path} 出错: {e}，重新抽取")
+    score_table, round_table = build_tables(path)
+    if use_cache:
+        try:
+            np.savez_compressed(
+                cache_path,
+                source=source,
+                **{f"score_{key}": value for key, value in score_table.items()},
+                **{f"round_{key}": value for key, value in round_table.items()}
+            )
+        except Exception as e:
+            print(f"写入缓存 {cache_path} 出错: {e}")
+    return score_table, round_table
+
+# 分数分布：按指标（或流派）统计 0-5 分、步长 0.5 的直方图
+def score_distribution(score_table, by="metric"):
+    labels = metrics if by == "metric" else genres
+    bins = np.clip(np.rint(score_table["score"] * 2).astype(np.int64), 0, 10)
+    counts = np.zeros((len(labels), 11), dtype=np.int64)
+    np.add.at(counts, (score_table[by].astype(np.int64), bins), 1)
+    return {label: counts[i].tolist() for i, label in enumerate(labels) if counts[i].any()}
+
+# 各流派在各指标上的平均分
+def mean_scores(score_table):
+    key = score_table["genre"].astype(np.int64) * len(metrics) + score_table["metric"]
+    size = len(genres) * len(metrics)
+    totals = np.bincount(key, weights=score_table["score"], minlength=size).reshape(len(genres), len(metrics))
+    counts = np.bincount(key, minlength=size).reshape(len(genres), len(metrics))
+    means = np.divide(totals, counts, out=np.full(totals.shape, np.nan), where=counts > 0)
+    return {genre: {metric: round(float(means[g, m]), 3) for m, metric in enumerate(metrics) if counts[g, m]} for g, genre in enumerate(genres) if counts[g].any()}
+
+# 组键：把 (对话, 轮次[, 附加列]) 打包为一个 int64（第一列之后每列占 16 位）后压缩为连续编号
+def group_ids(*columns):
+    key = columns[0].astype(np.int64)
+    for column in columns[1:]:
+        key = (key << 16) | (column.astype(np.int64) & 0xFFFF)
+    return np.unique(key, return_inverse=True)[1]
+
+# 流派胜率：同一轮被评估的流派中三项平均分最高者记为胜出（并列取 genres 中靠前者），胜率 = 胜出轮数 / 参评轮数
+def genre_win_rates(score_table):
+    mask = (score_table["iteration"] == 0) & (score_table["genre"] < genres.index("General"))
+    dialogue, round_num, genre = score_table["dialogue"][mask], score_table["round"][mask], score_table["genre"][mask]
+    if not genre.size:
+        return {}
+    entry = group_ids(dialogue, round_num, genre)
+    means = np.bincount(entry, weights=score_table["score"][mask]) / np.bincount(entry)
+    first = np.unique(entry, return_index=True)[1]
+    entry_round = group_ids(dialogue[first], round_num[first])
+    entry_genre = genre[first].astype(np.int64)
+    order = np.lexsort((entry_genre, -means, entry_round))
+    winners = entry_genre[order[np.r_[True, entry_round[order][1:] != entry_round[order][:-1]]]]
+    wins = np.bincount(winners, minlength=len(genres))
+    appearances = np.bincount(entry_genre, minlength=len(genres))
+    return {genre: {"wins": int(wins[g]), "rounds": int(appearances[g]), "win_rate": round(float(wins[g] / appearances[g]), 3)} for g, genre in enumerate(genres) if appearances[g]}
+
+# 整合达到阈值所需的迭代次数：每轮取三项平均分首次 >= threshold 的迭代，未达到记为 -1
+def iterations_to_threshold(score_table, threshold=4.0):
+    mask = score_table["genre"] == genres.index("Integration")
+    dialogue, round_num, iteration = score_table["dialogue"][mask], score_table["round"][mask], score_table["iteration"][mask]
+    if not iteration.size:
+        return {}
+    entry = group_ids(dialogue, round_num, iteration)
+    means = np.bincount(entry, weights=score_table["score"][mask]) / np.bincount(entry)
+    first = np.unique(entry, return_index=True)[1]
+    entry_round = group_ids(dialogue[first], round_num[first])
+    reached = np.full(entry_round.max() + 1, np.iinfo(np.int64).max)
+    hit = means >= threshold
+    np.minimum.at(reached, entry_round[hit], iteration[first][hit].astype(np.int64))
+    reached[reached == np.iinfo(np.int64).max] = -1
+    values, counts = np.unique(reached, return_counts=True)
+    return {int(value): int(count) for value, count in zip(values, counts)}
+
+def selection_counts(round_table):
+    selected = (round_table["selected"][:, None].astype(np.int64) >> np.arange(len(genres))) & 1
+    totals = selected.sum(axis=0)
+    return {genre: int(totals[g]) for g, genre in enumerate(genres) if totals[g]}
+
+def summarize(path, threshold=4.0, use_cache=True):
+    start = time.perf_counter()
+    score_table, round_table = load_tables(path, use_cache=use_cache)
+    loaded = time.perf_counter()
+    summary = {
+        "dialogues": int(np.unique(round_table["dialogue"]).size),
+        "rounds": int(round_table["round"].size),
+        "scores": int(score_table["score"].size),
+        "selection_counts": selection_counts(round_table),
+        "mean_scores": mean_scores(score_table),
+        "genre_win_rates": genre_win_rates(score_table),
+        "integration_rounds": int((round_table["iterations"] > 0).sum()),
+        "mean_integration_iterations": round(float(round_table["iterations"][round_table["iterations"] > 0].mean()), 3) if (round_table["iterations"] > 0).any() else None,
+        "iterations_to_threshold": iterations_to_threshold(score_table, threshold),
+        "score_distribution": score_distribution(score_table),
+    }
+    summary["timing"] = {"load_seconds": round(loaded - start, 4), "summary_seconds": round(time.perf_counter() - loaded, 4)}
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize evaluator scores of a test_results file")
+    parser.add_argument('results', type=str, help="test_results file (.json, .jsonl, .jsonl.gz or .jsonl.zst)")
+    parser.add_argument('--threshold', type=float, default=4.0, help="Integration score threshold used for iterations-to-threshold")
+    parser.add_argument('--no_cache', action='store_true', help="Rebuild the score table without reading or writing the .scores.npz cache")
+    args = parser.parse_args()
+    print(json.dumps(summarize(args.results, threshold=args.threshold, use_cache=not args.no_cache), ensure_ascii=False, indent=4))
@@ -3,9 +3,23 @@ import json
 import os
 import copy
 from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from collections import deque
+import threading
+import queue
+import itertools
+import heapq
+import sqlite3
+import zlib
+import time
+import random
+import hashlib
+from types import SimpleNamespace
 import re
-from ollama import Client as OllamaClient
+from ollama import Client as OllamaClient, ResponseError
 import argparse
+from 结果文件读写 import open_results_stream, write_result_record, read_results_stream, iter_test_results
+from 分布式任务队列 import open_work_queue, init_work_queue, start_lease_heartbeat, iter_claims, default_worker_id
 
 # 清理函数
 def clean_text(text, remove_think=False):
@@ -25,12 +39,15 @@ def clean_text(text, remove_think=False):
     return cleaned
 
 # 提取评分
+# 评分格式；extract_score 与输出格式提前结束的 score_complete 共用，判断标准保持一致
+score_pattern = re.compile(r'评分[:：]?\s*(\d(?:\.\d)?)\s*(?:分)?\b', re.IGNORECASE)
+
 def extract_score(text):
     if not isinstance(text, str):
         print(f"警告：输入不是字符串，类型为 {type(text)}，默认返回 0.0。")
         return 0.0
     cleaned_text = clean_text(text, remove_think=True)
-    match = re.search(r'评分[:：]?\s*(\d(?:\.\d)?)\s*(?:分)?\b', cleaned_text, re.IGNORECASE)
+    match = score_pattern.search(cleaned_text)
     if match:
         score = float(match.group(1))
         if 0 <= score <= 5:
@@ -43,26 +60,663 @@ def extract_score(text):
         print(f"警告：无法从 '{cleaned_text}' 中提取评分，原始文本：{text}")
         return 0.0
 
+# 单次请求的 HTTP 超时：call_agent 把调用截止时间写入 call_context，CustomOllamaClient 将其逐层传到实际发送请求的线程，
+# TimedOllamaClient 再作为 httpx 的请求超时传入；超时后连接被关闭，Ollama 随之停止生成，而不只是调用方不再等待
+request_deadline = threading.local()
+
+class TimedOllamaClient(OllamaClient):
+    def _request(self, cls, *args, stream=False, **kwargs):
+        deadline = getattr(request_deadline, "value", None)
+        if deadline is not None:
+            kwargs["timeout"] = max(deadline - time.monotonic(), 0.1)
+        return super()._request(cls, *args, stream=stream, **kwargs)
+
+# 多实例负载均衡：同一模型由多个 Ollama 进程（不同端口或主机）提供时，配置项写 "base_urls": [...]。
+# 每次请求选在途请求最少的健康实例；连续失败 backend_eject_after 次的实例被摘除，
+# 后台健康检查（GET /api/tags）恢复后重新加入。同一模型、同一组地址的客户端共享一个实例池
+backend_eject_after = 3
+backend_eject_seconds = 30
+backend_health_interval = 10
+
+class BackendPool:
+    def __init__(self, model, urls, timeout):
+        self.model = model
+        self.instances = [
+            {"url": url, "client": TimedOllamaClient(host=url, timeout=timeout), "outstanding": 0, "failures": 0, "ejected_until": 0.0, "requests": 0, "errors": 0}
+            for url in urls
+        ]
+        self.lock = threading.Lock()
+        if len(self.instances) > 1:
+            threading.Thread(target=self._health_loop, daemon=True).start()
+
+    # 全部实例都被摘除时仍选最早到期的一个，避免请求直接失败
+    def acquire(self):
+        now = time.monotonic()
+        with self.lock:
+            healthy = [inst for inst in self.instances if inst["ejected_until"] <= now]
+            if healthy:
+                instance = min(healthy, key=lambda inst: (inst["outstanding"], random.random()))
+            else:
+                instance = min(self.instances, key=lambda inst: inst["ejected_until"])
+            instance["outstanding"] += 1
+            instance["requests"] += 1
+            return instance
+
+    def release(self, instance, elapsed=None):
+        with self.lock:
+            instance["outstanding"] -= 1
+            if elapsed is not None:
+                instance["failures"] = 0
+                return
+            instance["errors"] += 1
+            instance["failures"] += 1
+            if instance["failures"] >= backend_eject_after and instance["ejected_until"] <= time.monotonic():
+                instance["ejected_until"] = time.monotonic() + backend_eject_seconds
+                count_metric(f"backend.{self.model}@{instance['url']}.ejected")
+                print(f"后端 {instance['url']}（{self.model}）连续失败 {instance['failures']} 次，暂时摘除")
+
+    def _health_loop(self):
+        while True:
+            time.sleep(backend_health_interval)
+            with self.lock:
+                ejected = [inst for inst in self.instances if inst["ejected_until"]]
+            for instance in ejected:
+                try:
+                    instance["client"].list()
+                except Exception:
+                    with self.lock:
+                        instance["ejected_until"] = max(instance["ejected_until"], time.monotonic() + backend_health_interval)
+                    continue
+                with self.lock:
+                    instance["ejected_until"] = 0.0
+                    instance["failures"] = 0
+                count_metric(f"backend.{self.model}@{instance['url']}.restored")
+                print(f"后端 {instance['url']}（{self.model}）健康检查通过，重新加入")
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                inst["url"]: {
+                    "healthy": inst["ejected_until"] <= now,
+                    "outstanding": inst["outstanding"],
+                    "requests": inst["requests"],
+                    "errors": inst["errors"],
+                    "p50": metric_percentile(f"backend.{self.model}@{inst['url']}", 50),
+                    "p95": metric_percentile(f"backend.{self.model}@{inst['url']}", 95)
+                }
+                for inst in self.instances
+            }
+
+backend_pools = {}
+backend_pools_lock = threading.Lock()
+
+def get_backend_pool(model, urls, timeout):
+    with backend_pools_lock:
+        key = (model, tuple(urls))
+        if key not in backend_pools:
+            backend_pools[key] = BackendPool(model, urls, timeout)
+        return backend_pools[key]
+
+def backend_pool_stats():
+    with backend_pools_lock:
+        pools = list(backend_pools.values())
+    stats = {}
+    for pool in pools:
+        stats.setdefault(pool.model, {}).update(pool.stats())
+    return stats
+
+# 模型预热：启动时并发加载角色配置用到的全部模型（config_list 各项和 model_routes 中的主、备模型，每个模型的全部后端，包括对冲后端），
+# 可选用该模型最长的静态系统提示词预填 KV 缓存，使第一轮的延迟反映稳定状态；各后端的冷加载时间记为 warmup.<模型>@<后端>，
+# 结果写入调用指标的 "warmup"。预热请求带上默认调用策略的 num_ctx，避免第一次正式调用因上下文长度不同而重新加载。
+# keep_alive（如 -1 或 "2h"）让模型在本次运行期间常驻：预热请求和 CustomOllamaClient 的每次调用都带上该值
+# （Ollama 收到不带 keep_alive 的请求会恢复默认的 5 分钟；内置 ollama 客户端可在服务端设置 OLLAMA_KEEP_ALIVE）。
+# 运行中加载时间超过 cold_load_seconds 的调用记为 backend.<模型>.cold_load，说明模型曾被换出
+keep_alive = None
+cold_load_seconds = 1.0
+warmup_report = []
+
+def parse_keep_alive(value):
+    return int(value) if value.lstrip("-").isdigit() else value
+
+def ollama_host(entry):
+    host = entry.get("client_host") or entry.get("base_url") or "http://localhost:11434"
+    return host[:-len("/v1")] if host.endswith("/v1") else host
+
+def warmup_targets():
+    urls = {}
+    for entry in config_list:
+        model_urls = urls.setdefault(entry["model"], [])
+        for url in (entry.get("base_urls") or [ollama_host(entry)]) + ([entry["hedge_base_url"]] if entry.get("hedge_base_url") else []):
+            if url not in model_urls:
+                model_urls.append(url)
+    default_urls = next(iter(urls.values()), [])
+    for route in model_routes.values():
+        for model in (route.get("primary"), route.get("fallback")):
+            if model and model not in urls:
+                urls[model] = list(default_urls)
+    return [(model, url) for model, model_urls in urls.items() for url in model_urls]
+
+def warmup_prompts():
+    prompts = {}
+    for agent in prompt_agents().values():
+        model = agent.llm_config["config_list"][0]["model"]
+        if len(agent.system_message) > len(prompts.get(model, "")):
+            prompts[model] = agent.system_message
+    return prompts
+
+def warmup_model(model, url, prompt=None):
+    client = OllamaClient(host=url)
+    kwargs = {"keep_alive": keep_alive} if keep_alive is not None else {}
+    if call_policies["default"].get("num_ctx"):
+        kwargs["options"] = {"num_ctx": call_policies["default"]["num_ctx"]}
+    start = time.monotonic()
+    response = client.generate(model=model, prompt="", **kwargs)
+    result = {"model": model, "url": url, "load_seconds": round((response.get("load_duration") or 0) / 1e9, 3), "seconds": round(time.monotonic() - start, 3)}
+    if prompt:
+        start = time.monotonic()
+        response = client.chat(model=model, messages=[{"role": "system", "content": prompt}], **{**kwargs, "options": {**kwargs.get("options", {}), "num_predict": 1}})
+        result["prefill_tokens"] = response.get("prompt_eval_count") or 0
+        result["prefill_seconds"] = round(time.monotonic() - start, 3)
+    observe_metric(f"warmup.{model}@{url}", result["seconds"])
+    return result
+
+def warmup_models(prefill=False):
+    targets = warmup_targets()
+    prompts = warmup_prompts() if prefill else {}
+    print(f"预热 {len(targets)} 个模型后端: {targets}")
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(len(targets), 1)) as executor:
+        futures = {executor.submit(warmup_model, model, url, prompts.get(model)): (model, url) for model, url in targets}
+        for future in as_completed(futures):
+            model, url = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                count_metric(f"warmup.{model}@{url}.error")
+                print(f"预热 {model}@{url} 出错: {e}")
+                continue
+            warmup_report.append(result)
+            prefill_note = f"，预填 {result['prefill_tokens']} token 用时 {result['prefill_seconds']} 秒" if "prefill_tokens" in result else ""
+            print(f"模型 {model}@{url} 冷加载 {result['load_seconds']} 秒（请求用时 {result['seconds']} 秒）{prefill_note}")
+    print(f"预热完成，用时 {time.monotonic() - start:.2f} 秒")
+    return warmup_report
+
+# 推理模型的思考预算（调用策略中的 think_budget）：None 不限制；0 关闭推理（think=False）；正数时流式读取，
+# 思考部分（message.thinking 或内联 <think> 块，每个流式片段约一个 token）超出预算即断开连接，带上已有思考以 think=False 追问最终回答。
+# 不支持 think 参数的模型记入 non_thinking_models，之后不再传该参数
+non_thinking_models = set()
+think_reprompt = "思考已达到上限，请不要继续思考，直接按要求给出最终回答。"
+
+# 非流式调用时按字符比例估算思考 token 数
+def estimate_think_tokens(response):
+    message = response["message"]
+    content = message.get("content") or ""
+    thinking = (message.get("thinking") or "") + "".join(re.findall(r'<think>(.*?)</think>', content, flags=re.DOTALL))
+    total = len(message.get("thinking") or "") + len(content)
+    return round((response.get("eval_count") or 0) * len(thinking) / total) if thinking else 0
+
+# 输出格式提前结束（调用策略中的 early_stop）：流式读取时，思考之外的输出一旦满足所需格式即断开连接，并截去格式之后的部分。
+# 检查函数返回完整部分的结束位置，未完成时返回 None。
+# score：已有可提取的评分，且修改意见已换行结束或达到 50 字；genres：选择器输出以句号结束且全部是有效流派名称
+def score_complete(text):
+    match = score_pattern.search(text)
+    label = text.find("修改意见", match.end()) if match else -1
+    if label < 0:
+        return None
+    start = label + len("修改意见")
+    line = re.match(r'[：:]?\s*(\S[^\n]*)\n', text[start:])
+    if line:
+        return start + line.end(1)
+    return len(text) if len(text[start:].lstrip("：: ").strip()) >= 50 else None
+
+def genres_complete(text):
+    end = text.find("。")
+    if end < 0:
+        return None
+    selected_genres_cn = parse_selector_reply(clean_text(text[:end]))
+    return end + 1 if selected_genres_cn and all(genre in genre_mapping for genre in selected_genres_cn) else None
+
+early_stop_checks = {"score": score_complete, "genres": genres_complete}
+
+# 结构化输出：按 JSON schema 约束输出（Ollama 的 format 参数），校验后转换回原有文本格式（评分：X.X分\n修改意见：...／流派、流派。），
+# 下游的 extract_score 和 parse_selector_reply 不变。格式不符时附上错误发送一次简短的修复提示，而不是重新运行整个评估。
+# structured_output 为 True 时按 structured_formats 启用，调用策略中的 "format" 可单独为某个角色指定
+structured_output = False
+structured_formats = {"selector": "genres", "evaluator": "score", "integration_eval": "score"}
+structured_repairs = 1
+output_schemas = {
+    "score": {
+        "type": "object",
+        "properties": {"score": {"type": "number", "minimum": 0, "maximum": 5}, "suggestion": {"type": "string"}},
+        "required": ["score", "suggestion"]
+    },
+    "genres": {
+        "type": "object",
+        "properties": {"genres": {"type": "array", "items": {"type": "string"}, "minItems": 1, "maxItems": 2}},
+        "required": ["genres"]
+    }
+}
+
+# 流派列表的取值限定为 genre_mapping 中的名称（genre_mapping 在代理定义处给出）
+def output_schema(schema_name):
+    schema = copy.deepcopy(output_schemas[schema_name])
+    if schema_name == "genres":
+        schema["properties"]["genres"]["items"]["enum"] = list(genre_mapping)
+    return schema
+output_examples = {"score": '{"score": 4.0, "suggestion": "50字以内的修改意见"}', "genres": '{"genres": ["认知行为疗法", "人本主义疗法"]}'}
+
+# 返回 (转换后的文本, None) 或 (None, 错误说明)
+def render_structured(schema_name, raw):
+    try:
+        data = json.loads(re.sub(r'<think>.*?</think>', '', raw or "", flags=re.DOTALL).strip())
+    except json.JSONDecodeError as e:
+        return None, f"不是合法的 JSON：{e.msg}"
+    if not isinstance(data, dict):
+        return None, "输出应为 JSON 对象"
+    if schema_name == "score":
+        score, suggestion = data.get("score"), data.get("suggestion")
+        if isinstance(score, bool) or not isinstance(score, (int, float)) or not 0 <= score <= 5:
+            return None, "score 应为 0-5 之间的数字"
+        if not isinstance(suggestion, str) or not suggestion.strip():
+            return None, "suggestion 应为非空字符串"
+        return f"评分：{round(float(score), 1)}分\n修改意见：{clean_text(suggestion).strip()}", None
+    genres = data.get("genres")
+    if not isinstance(genres, list) or not 1 <= len(genres) <= 2:
+        return None, "genres 应为包含 1-2 个流派名称的列表"
+    invalid = [genre for genre in genres if genre not in genre_mapping]
+    if invalid:
+        return None, f"未知流派 {invalid}，只能从 {list(genre_mapping)} 中选择"
+    return "、".join(genres) + "。", None
+
 # 自定义 Ollama 客户端
+# 在配置项中写入 "model_client_cls": "CustomOllamaClient" 后由 autogen 调用；
+# 可选 "timeout"（HTTP 超时秒数）、"hedge_base_url"（对冲请求使用的第二个后端）、"max_concurrency"（该模型同时在途的请求数上限）
+# 与 "base_urls"（提供同一模型的多个后端，见 BackendPool）
 class CustomOllamaClient:
-    def __init__(self, config):
-        self.client = OllamaClient(host=config["base_url"])
+    def __init__(self, config, **kwargs):
         self.model = config["model"]
+        self.pool = get_backend_pool(self.model, config.get("base_urls") or [config["base_url"]], config.get("timeout", 300))
+        hedge_base_url = config.get("hedge_base_url")
+        self.hedge_client = TimedOllamaClient(host=hedge_base_url, timeout=config.get("timeout", 300)) if hedge_base_url else None
+        if config.get("max_concurrency"):
+            model_scheduler.set_limit(self.model, config["max_concurrency"])
 
     def create(self, params):
         messages = params.get("messages", [])
         cleaned_messages = [
             {**msg, "content": clean_text(msg["content"])} for msg in messages
         ]
-        response = self.client.chat(model=self.model, messages=cleaned_messages)
+        role = getattr(call_context, "role", None)
+        deadline = getattr(call_context, "deadline", None)
+        model = route_model(role, self.model)
+        if request_batcher is not None and role and role.split(":")[0] in batched_roles:
+            response = request_batcher.submit((model, role), self._chat_scheduled, cleaned_messages, role, model, deadline)
+        else:
+            response = self._chat_scheduled(cleaned_messages, role, model, deadline)
         content = clean_text(response["message"]["content"])
+        prompt_tokens = response.get("prompt_eval_count") or 0
+        completion_tokens = response.get("eval_count") or 0
+        num_ctx = get_call_policy(role).get("num_ctx")
+        calibrate_tokens(model, sum(len(msg["content"]) for msg in cleaned_messages), prompt_tokens, num_ctx)
+        if num_ctx and prompt_tokens:
+            observe_metric(f"context.{role or 'default'}.utilization", round(prompt_tokens / num_ctx, 3))
+        return SimpleNamespace(
+            model=model,
+            cost=0,
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content, function_call=None, tool_calls=None), finish_reason="stop")],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
+        )
+
+    def _timed_chat(self, client, messages, model, role, deadline=None):
+        start = time.monotonic()
+        try:
+            response = self._generate(client, messages, model, role, deadline)
+        except Exception:
+            count_metric(f"backend.{model}.error")
+            raise
+        observe_metric(f"backend.{model}", time.monotonic() - start)
+        if (response.get("load_duration") or 0) / 1e9 > cold_load_seconds:
+            count_metric(f"backend.{model}.cold_load")
+        return response
+
+    @staticmethod
+    def _chat(client, model, messages, deadline=None, **kwargs):
+        if keep_alive is not None:
+            kwargs.setdefault("keep_alive", keep_alive)
+        if model in non_thinking_models:
+            kwargs.pop("think", None)
+        request_deadline.value = deadline
+        try:
+            return client.chat(model=model, messages=messages, **kwargs)
+        except ResponseError as e:
+            if kwargs.get("think") is None or "think" not in str(e).lower():
+                raise
+            non_thinking_models.add(model)
+            print(f"模型 {model} 不支持 think 参数，之后不再传入")
+            kwargs.pop("think")
+            return client.chat(model=model, messages=messages, **kwargs)
+        finally:
+            request_deadline.value = None
+
+    def _generate(self, client, messages, model, role, deadline=None):
+        role = role or "default"
+        policy = get_call_policy(role)
+        think_budget = policy.get("think_budget")
+        options = {key: policy[key] for key in ("num_predict", "stop", "num_ctx") if policy.get(key)}
+        kwargs = {"options": options} if options else {}
+        if think_budget is not None and think_budget <= 0:
+            count_metric(f"think.{role}.disabled")
+            kwargs["think"] = False
+        elif think_budget:
+            kwargs["think"] = True
+        schema_name = policy.get("format") or (structured_formats.get(role.split(":")[0]) if structured_output else None)
+        if schema_name:
+            if kwargs.get("think"):
+                kwargs["think"] = False
+            return self._generate_structured(client, messages, model, role, schema_name, kwargs, deadline)
+        is_complete = early_stop_checks.get(policy.get("early_stop"))
+        if not is_complete and not kwargs.get("think"):
+            response = self._chat(client, model, messages, deadline, **kwargs)
+            observe_metric(f"think.{role}.tokens", 0 if "think" in kwargs else estimate_think_tokens(response))
+            return response
+        thinking, content, think_tokens, tokens, last, stopped = "", "", 0, 0, None, None
+        stream = self._chat(client, model, messages, deadline, stream=True, **kwargs)
+        try:
+            for chunk in stream:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise CallTimeout(f"{role} 流式读取超过调用截止时间")
+                last = chunk
+                tokens += 1
+                if chunk["message"].get("thinking"):
+                    thinking += chunk["message"]["thinking"]
+                    think_tokens += 1
+                if chunk["message"].get("content"):
+                    content += chunk["message"]["content"]
+                    answer = content.split("</think>")[-1]
+                    if content.count("<think>") > content.count("</think>"):
+                        think_tokens += 1
+                    elif is_complete and is_complete(answer) is not None:
+                        content = content[:len(content) - len(answer) + is_complete(answer)]
+                        stopped = "early_stop"
+                        break
+                if think_budget and think_tokens > think_budget:
+                    stopped = "truncated"
+                    break
+        finally:
+            stream.close()
+        observe_metric(f"think.{role}.tokens", think_tokens)
+        if stopped != "truncated":
+            if stopped:
+                count_metric(f"generate.{role}.early_stop")
+            observe_metric(f"generate.{role}.tokens", tokens)
+            return {
+                "message": {"role": "assistant", "content": (f"<think>{thinking}</think>" if thinking else "") + content},
+                "prompt_eval_count": (last.get("prompt_eval_count") if last else 0) or 0,
+                "eval_count": (last.get("eval_count") if last and not stopped else tokens) or 0
+            }
+        count_metric(f"think.{role}.truncated")
+        partial = thinking or content.split("<think>", 1)[-1]
+        followup = messages + [{"role": "user", "content": f"{think_reprompt}\n\n已有的思考（已截断）：{partial}"}]
+        response = self._chat(client, model, followup, deadline, **{**kwargs, "think": False})
+        return {
+            "message": {"role": "assistant", "content": f"<think>{partial}</think>{response['message']['content']}"},
+            "prompt_eval_count": response.get("prompt_eval_count"),
+            "eval_count": think_tokens + (response.get("eval_count") or 0)
+        }
+
+    def _generate_structured(self, client, messages, model, role, schema_name, kwargs, deadline=None):
+        prompt_tokens = completion_tokens = 0
+        attempt_messages = messages
+        for attempt in range(structured_repairs + 1):
+            response = self._chat(client, model, attempt_messages, deadline, format=output_schema(schema_name), **kwargs)
+            prompt_tokens += response.get("prompt_eval_count") or 0
+            completion_tokens += response.get("eval_count") or 0
+            raw = response["message"]["content"]
+            text, error = render_structured(schema_name, raw)
+            if text is not None:
+                if attempt:
+                    count_metric(f"format.{role}.repaired")
+                return {"message": {"role": "assistant", "content": text}, "prompt_eval_count": prompt_tokens, "eval_count": completion_tokens}
+            count_metric(f"format.{role}.invalid")
+            print(f"{role} 输出格式不符（{error}）: {raw}")
+            attempt_messages = messages + [
+                {"role": "assistant", "content": raw},
+                {"role": "user", "content": f"上一条输出格式不符：{error}。请只输出符合格式的 JSON，例如 {output_examples[schema_name]}"}
+            ]
+        count_metric(f"format.{role}.failed")
+        return {"message": {"role": "assistant", "content": raw}, "prompt_eval_count": prompt_tokens, "eval_count": completion_tokens}
+
+    def _pooled_chat(self, messages, model, role, deadline=None):
+        instance = self.pool.acquire()
+        start = time.monotonic()
+        try:
+            response = self._timed_chat(instance["client"], messages, model, role, deadline)
+        except Exception:
+            self.pool.release(instance)
+            raise
+        elapsed = time.monotonic() - start
+        observe_metric(f"backend.{model}@{instance['url']}", elapsed)
+        self.pool.release(instance, elapsed)
+        return response
+
+    # 批处理槽位线程中没有 call_context，角色和截止时间由调用方传入
+    def _chat_scheduled(self, messages, role, model, deadline=None):
+        model_scheduler.acquire(model, role)
+        try:
+            return self._chat_hedged(messages, model, role, deadline)
+        finally:
+            model_scheduler.release(model)
+
+    # 对冲请求：主后端超过 p95 延迟仍未返回时，向第二个后端发送相同请求，取先返回者
+    def _chat_hedged(self, messages, model, role, deadline=None):
+        hedge_delay = metric_percentile(f"backend.{model}", 95, min_samples=hedge_min_samples)
+        if self.hedge_client is None or hedge_delay is None:
+            return self._pooled_chat(messages, model, role, deadline)
+        primary = hedge_executor.submit(self._pooled_chat, messages, model, role, deadline)
+        try:
+            return primary.result(timeout=hedge_delay)
+        except FutureTimeoutError:
+            pass
+        count_metric(f"hedge.{model}.sent")
+        backup = hedge_executor.submit(self._timed_chat, self.hedge_client, messages, model, role, deadline)
+        error = None
+        for future in as_completed([primary, backup]):
+            try:
+                response = future.result()
+            except Exception as e:
+                error = e
+                continue
+            count_metric(f"hedge.{model}.{'backup_won' if future is backup else 'primary_won'}")
+            return response
+        raise error
+
+    def message_retrieval(self, response):
+        return [choice.message.content for choice in response.choices]
+
+    def cost(self, response):
+        return 0
+
+    @staticmethod
+    def get_usage(response):
         return {
-            "choices": [{"message": {"content": content}}],
-            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            "prompt_tokens": response.usage.prompt_tokens,
+            "completion_tokens": response.usage.completion_tokens,
+            "total_tokens": response.usage.total_tokens,
+            "cost": 0,
+            "model": response.model
         }
 
+hedge_executor = ThreadPoolExecutor(max_workers=8)
+hedge_min_samples = 20  # 延迟样本数达到该值后才启用对冲
+
+# 跨会话请求批处理：同一模型、同一角色的请求先排队，最多等待 window 秒或凑满 max_size 个后一起派发。
+# Ollama 没有批量推理接口，批内请求通过 slots 个并行槽位同时发出（与服务端 OLLAMA_NUM_PARALLEL 对应），
+# 相同系统提示词的请求集中到达后端。仅作用于使用 CustomOllamaClient 的代理
+class RequestBatcher:
+    def __init__(self, window, max_size, slots):
+        self.window = window
+        self.max_size = max_size
+        self.slots = ThreadPoolExecutor(max_workers=slots)
+        self.pending = {}
+        self.deadlines = {}
+        self.cond = threading.Condition()
+        threading.Thread(target=self._dispatch_loop, daemon=True).start()
+
+    def submit(self, key, func, *args):
+        future = Future()
+        with self.cond:
+            queue = self.pending.setdefault(key, [])
+            queue.append((func, args, future, time.monotonic()))
+            if len(queue) == 1:
+                self.deadlines[key] = time.monotonic() + self.window
+            if len(queue) >= self.max_size:
+                self._flush(key)
+            else:
+                self.cond.notify()
+        return future.result()
+
+    def _flush(self, key):
+        batch = self.pending.pop(key)
+        self.deadlines.pop(key, None)
+        name = key[1].split(":")[0]
+        observe_metric(f"batch.{name}.size", len(batch))
+        count_metric(f"batch.{name}.dispatched")
+        for func, args, future, enqueued in batch:
+            self.slots.submit(self._run, name, func, args, future, enqueued)
+
+    # 排队等待时间包括批处理窗口和等待空闲槽位的时间
+    @staticmethod
+    def _run(name, func, args, future, enqueued):
+        observe_metric(f"batch.{name}.queue_wait", time.monotonic() - enqueued)
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def _dispatch_loop(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                for key in [key for key, deadline in self.deadlines.items() if deadline <= now]:
+                    self._flush(key)
+                self.cond.wait(min(self.deadlines.values()) - now if self.deadlines else None)
+
+batched_roles = {"genre", "evaluator", "integration_eval"}  # 多个会话常在同一阶段并发调用的角色
+request_batcher = None  # 默认关闭，单个后端时批处理只会增加等待；用 configure_request_batching（--batch_window_ms）开启
+
+# 调整批处理参数；window_ms 为 0 时关闭批处理，请求直接发往后端
+def configure_request_batching(window_ms, max_size, slots):
+    global request_batcher
+    request_batcher = RequestBatcher(window_ms / 1000, max_size, slots) if window_ms > 0 else None
+
+# 按模型限流的优先级调度：每个后端模型一个等待队列，同时在途的请求不超过该模型的并发上限，
+# 空出的槽位按角色优先级分配（数值小者优先，同级先到先得）。选择器和整合器决定下一阶段何时开始，优先级最高；
+# 推测执行的通用型 Agent 和流派评估最低。上限为 0 时不限制并发，只统计排队情况
+role_priorities = {"selector": 0, "integrator": 0, "general": 1, "genre": 1, "integration_eval": 1, "evaluator": 2}
+speculative_priority = 3
+
+def role_priority(role):
+    name = role.split(":")[0] if role else None
+    if name == "general" and speculative_general:
+        return speculative_priority
+    return role_priorities.get(name, 1)
+
+class ModelScheduler:
+    def __init__(self, default_limit=0):
+        self.default_limit = default_limit
+        self.limits = {}
+        self.active = {}
+        self.queues = {}
+        self.tickets = itertools.count()
+        self.cond = threading.Condition()
+
+    def set_limit(self, model, limit):
+        with self.cond:
+            self.limits[model] = limit
+            self.cond.notify_all()
+
+    def _has_slot(self, model):
+        limit = self.limits.get(model, self.default_limit)
+        return not limit or self.active.get(model, 0) < limit
+
+    def acquire(self, model, role=None):
+        ticket = (role_priority(role), next(self.tickets))
+        start = time.monotonic()
+        with self.cond:
+            queue = self.queues.setdefault(model, [])
+            heapq.heappush(queue, ticket)
+            observe_metric(f"sched.{model}.depth", len(queue))
+            while queue[0] != ticket or not self._has_slot(model):
+                self.cond.wait()
+            heapq.heappop(queue)
+            self.active[model] = self.active.get(model, 0) + 1
+            self.cond.notify_all()
+        wait = time.monotonic() - start
+        observe_metric(f"sched.{model}.queue_wait", wait)
+        observe_metric(f"sched.role.{role.split(':')[0] if role else 'default'}.queue_wait", wait)
+
+    def release(self, model):
+        with self.cond:
+            self.active[model] -= 1
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                model: {"limit": self.limits.get(model, self.default_limit), "active": self.active.get(model, 0), "queued": len(self.queues.get(model, []))}
+                for model in set(self.active) | set(self.queues) | set(self.limits)
+            }
+
+model_scheduler = ModelScheduler()
+
+# 设置未在配置项中指定 max_concurrency 的模型的默认并发上限
+def configure_model_scheduler(default_limit):
+    with model_scheduler.cond:
+        model_scheduler.default_limit = default_limit
+        model_scheduler.cond.notify_all()
+
+# 按角色路由模型：model_routes 为每个角色指定主模型和较小的备用模型，键可以是角色类别（"evaluator"）或完整角色名（"evaluator:GoalConsistency"），
+# 例如 {"evaluator": {"primary": "deepseek-r1:1.5b", "fallback": "llama3.1"}}；未配置的角色使用代理自身配置的模型。
+# 主模型最近 window 个样本的排队等待 p95 或延迟 p95 超过阈值时，优先级数值不小于 downgrade_priority 的角色改用备用模型。
+# 备用模型需要在同一组后端上可用。每次路由都计入 route.<角色>.<模型>，配置了备用模型的角色的决定及原因另记入 route_log
+model_routes = {}
+route_thresholds = {"queue_wait_p95": 2.0, "latency_p95": 60.0, "min_samples": 10, "window": 50}
+downgrade_priority = 2
+route_log = deque(maxlen=1000)
+
+def load_model_routes(path):
+    with open(path, "r", encoding="utf-8") as f:
+        routes = json.load(f)
+    route_thresholds.update(routes.pop("thresholds", {}))
+    for role, route in routes.items():
+        model_routes[role] = {**model_routes.get(role, {}), **route}
+    print(f"已加载模型路由: {model_routes}，降级阈值: {route_thresholds}")
+
+def role_route(role):
+    name = role.split(":")[0] if role else "default"
+    return {**model_routes.get(name, {}), **model_routes.get(role, {})} if role else {}
+
+def route_model(role, default_model):
+    name = role.split(":")[0] if role else "default"
+    route = role_route(role)
+    primary = route.get("primary", default_model)
+    model, reason = primary, "primary"
+    if route.get("fallback") and role_priority(role) >= downgrade_priority:
+        options = {"min_samples": route_thresholds["min_samples"], "window": route_thresholds["window"]}
+        wait = metric_percentile(f"sched.{primary}.queue_wait", 95, **options)
+        latency = metric_percentile(f"backend.{primary}", 95, **options)
+        if wait is not None and wait > route_thresholds["queue_wait_p95"]:
+            model, reason = route["fallback"], f"queue_wait_p95={wait:.2f}s"
+        elif latency is not None and latency > route_thresholds["latency_p95"]:
+            model, reason = route["fallback"], f"latency_p95={latency:.2f}s"
+    count_metric(f"route.{name}.{model}")
+    if route.get("fallback"):
+        route_log.append({"time": datetime.now().isoformat(timespec="seconds"), "role": role, "model": model, "reason": reason})
+    return model
+
 # 加载配置文件
-config_list = autogen.config_list_from_json("/root/code/QAI_CONFIG_LIST.json")
+config_list = autogen.config_list_from_json(os.environ.get("QAI_CONFIG_LIST", "/root/code/QAI_CONFIG_LIST.json"))
 llm_config = {"config_list": [config_list[0]]}
 llm_config2 = {"config_list": [config_list[2]]}
 
@@ -721,6 +1375,10 @@ def create_evaluators(selected_genres, include_general=False):
 - 输出仅包含可打印的 UTF-8 字符，避免代理字符或其他非法字符。输出无论何时都要严格要求给定的格式。
 """
     )
+    for evaluator in evaluators.values():
+        if prompt_variant != "full":
+            evaluator.update_system_message(compile_prompt(evaluator.system_message))
+        register_custom_client(evaluator)
     return evaluators
 
 text_integrator = autogen.AssistantAgent(
@@ -941,29 +1599,509 @@ integration_manager = autogen.AssistantAgent(
     system_message="管理整合流程：接收整合结果，传递给评估器；收集评估结果，优化文本；迭代最多5次，平均分≥4输出，否则选最高分版本。确保输出仅包含可打印的 UTF-8 字符。"
 )
 
+# 配置项指定 "model_client_cls": "CustomOllamaClient" 时为代理注册自定义客户端
+def register_custom_client(agent):
+    entries = agent.llm_config.get("config_list", []) if agent.llm_config else []
+    if any(entry.get("model_client_cls") == "CustomOllamaClient" for entry in entries):
+        agent.register_model_client(model_client_cls=CustomOllamaClient)
+    return agent
+
+for agent in [selector, general_agent, text_integrator, integration_manager, *genre_agents.values(), *integration_evaluators.values()]:
+    register_custom_client(agent)
+
+# 提示词编译：系统提示词有完整版（full，即上面各代理的原文）和精简版（compact），用 apply_prompt_variant 在运行时切换。
+# 精简版去掉流派提示词中的示例对话和提示词内部重复的行，把多处共用的样板句就地换成 prompt_fragments 中的短句
+# （保留原有的编号和小标题，含义不变），并合并空行；评估器的“示例”段落给出评分的输出格式，extract_score 依赖该格式，予以保留；
+# 提示词分析.py 统计两种版本的 token 数和跨提示词重复的行，并对比 prompt eval 耗时
+prompt_variant = "full"
+prompt_fragments = [
+    (re.compile(r'^(\s*(?:- |\d+\. )?\*\*字符限制\*\*：)确保输出仅包含可打印的 UTF-8 字符，避免代理字符或其他非法字符。\s*$'), r"\1输出仅含可打印的 UTF-8 字符。"),
+    (re.compile(r'^(\s*- )输出仅包含可打印的 UTF-8 字符，避免代理字符或其他非法字符。输出无论何时都要严格要求给定的格式。\s*$'), r"\1输出仅含可打印的 UTF-8 字符，严格遵守给定格式。")
+]
+full_prompts = {}
+
+def compile_prompt(text, variant=None):
+    if (variant or prompt_variant) == "full":
+        return text
+    lines, seen, skipping = [], set(), False
+    for line in text.splitlines():
+        stripped = line.strip()
+        if re.match(r'\*\*示例对话\*\*', stripped):
+            skipping = True
+            continue
+        if skipping:
+            if not re.match(r'(\*\*[^*]+\*\*|#{1,6} )', stripped):
+                continue
+            skipping = False
+        for pattern, fragment in prompt_fragments:
+            if pattern.match(line):
+                line = pattern.sub(fragment, line)
+                stripped = line.strip()
+        if len(stripped) >= 8 and stripped in seen:
+            continue
+        seen.add(stripped)
+        lines.append(line.rstrip())
+    return re.sub(r'\n{3,}', '\n\n', "\n".join(lines)).strip()
+
+# 全部代理按角色名列出；evaluators 为 True 时包括按流派生成的评估器（每次新建）
+def prompt_agents(evaluators=True):
+    agents = {"selector": selector, "general": general_agent, "integrator": text_integrator, "integration_manager": integration_manager}
+    agents.update({f"genre:{genre}": agent for genre, agent in genre_agents.items()})
+    agents.update({f"integration_eval:{key}": agent for key, agent in integration_evaluators.items()})
+    if evaluators:
+        agents.update({f"evaluator:{key}": agent for key, agent in create_evaluators(all_genres, include_general=True).items()})
+    return agents
+
+def apply_prompt_variant(variant):
+    global prompt_variant
+    prompt_variant = variant
+    for key, agent in prompt_agents(evaluators=False).items():
+        full_prompts.setdefault(key, agent.system_message)
+        agent.update_system_message(compile_prompt(full_prompts[key], variant))
+    print(f"使用 {variant} 版系统提示词")
+
+# 对话级发送方代理：共享的流派、评估和整合代理按发送方分别保存消息，
+# 每条数据使用自己的 User / IntegrationManager，多条数据可以同时运行
+def new_sender():
+    return autogen.UserProxyAgent(
+        name="User",
+        human_input_mode="NEVER",
+        is_termination_msg=lambda x: x.get("content", "").find("TERMINATE") >= 0,
+        code_execution_config=False
+    )
+
+def new_session_agents():
+    return {
+        "user_proxy": new_sender(),
+        "integration_manager": register_custom_client(autogen.AssistantAgent(
+            name="IntegrationManager",
+            llm_config=llm_config,
+            system_message=integration_manager.system_message
+        ))
+    }
+
+# 对话结束时清除共享代理中与该发送方相关的消息和计数
+def release_session_agents(session_agents):
+    for agent in [selector, general_agent, text_integrator, *genre_agents.values(), *integration_evaluators.values()]:
+        for sender in session_agents.values():
+            agent._oai_messages.pop(sender, None)
+            agent._consecutive_auto_reply_counter.pop(sender, None)
+            agent._max_consecutive_auto_reply_dict.pop(sender, None)
+            agent.reply_at_receive.pop(sender, None)
+
+# 内容寻址消息存储（--compact_history 开启）：聊天记录中较长的字符串按行计算摘要，每行正文只保存一份，
+# 记录中以 {"$ref": [摘要或 [短行原文], ...]} 引用。保存的文件形如 {"format": "message_store_v1", "messages": {摘要: 正文}, "data": 记录}，
+# 用 load_chat_history 还原为原有结构。消息存储按输出文件创建（new_message_store），写完即随之释放
+message_store_lock = threading.Lock()
+message_store_min_chars = 64  # 短于该长度的字符串直接保留
+message_store_min_line = 24  # 短于该长度的行直接内联，引用摘要反而更长
+compact_history = False  # True 时按 message_store_v1 格式保存聊天记录和测试结果
+
+def message_digest(line):
+    return hashlib.blake2b(line.encode("utf-8"), digest_size=8).hexdigest()
+
+# 为一个输出文件创建消息存储；未开启压缩时返回 None，intern_messages 与 save_chat_history 按原有结构处理
+def new_message_store():
+    return {} if compact_history else None
+
+# 返回记录的压缩副本，长字符串中的长行替换为摘要引用；store 为 None 时原样返回
+def intern_messages(obj, store):
+    if store is None:
+        return obj
+    if isinstance(obj, str):
+        if len(obj) < message_store_min_chars:
+            return obj
+        refs = []
+        with message_store_lock:
+            for line in obj.split("\n"):
+                if len(line) < message_store_min_line:
+                    refs.append([line])
+                    continue
+                digest = message_digest(line)
+                store.setdefault(digest, line)
+                refs.append(digest)
+        return {"$ref": refs}
+    if isinstance(obj, dict):
+        return {key: intern_messages(value, store) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [intern_messages(value, store) for value in obj]
+    return obj
+
+def expand_messages(obj, messages):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and "$ref" in obj:
+            return "\n".join(ref[0] if isinstance(ref, list) else messages[ref] for ref in obj["$ref"])
+        return {key: expand_messages(value, messages) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [expand_messages(value, messages) for value in obj]
+    return obj
+
+def collect_message_refs(obj, refs):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and "$ref" in obj:
+            refs.update(ref for ref in obj["$ref"] if isinstance(ref, str))
+            return
+        for value in obj.values():
+            collect_message_refs(value, refs)
+    elif isinstance(obj, list):
+        for value in obj:
+            collect_message_refs(value, refs)
+
+# 保存聊天记录；store 为 None 时按原有结构（indent=4）保存，否则写为压缩格式，只写入被引用到的正文
+def save_chat_history(path, data, store=None):
+    with open(path, "w", encoding="utf-8") as f:
+        if store is None:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+            return
+        refs = set()
+        collect_message_refs(data, refs)
+        with message_store_lock:
+            messages = {digest: store[digest] for digest in refs}
+        json.dump({"format": "message_store_v1", "messages": messages, "data": data}, f, ensure_ascii=False)
+
+# 读取聊天记录文件并还原为原有结构；兼容未压缩的文件
+def load_chat_history(path):
+    with open(path, "r", encoding="utf-8") as f:
+        doc = json.load(f)
+    if isinstance(doc, dict) and doc.get("format") == "message_store_v1":
+        return expand_messages(doc["data"], doc["messages"])
+    return doc
+
 # 全局变量
 all_chat_history = {}
 conversation_history = []
 selector_state = {"last_selected_genres": [], "inactive_rounds": 0, "selector_active": True}
 all_genres = ["CBT", "SFT", "PA", "NT", "HT"]
+# 整合评估器并发运行，各评估器只看到整合文本；False 时按 autogen.initiate_chats 的方式串行，
+# 后一个评估器的消息带上之前评估器的输出（Context），与原有提示词一致
+parallel_integration_eval = True
+
+# 运行一组单轮对话，结果按队列顺序返回。与 autogen.initiate_chats 相同，每个对话的 carryover 为其自带的 carryover
+# 加上之前各对话的摘要（finished_chat_indexes_to_exclude_from_carryover 中的除外）；
+# 排除了之前全部对话的对话立即并发发起，其余等所依赖的对话完成后带上摘要再发起
+def run_chats_concurrently(chat_queue, budget=None, stage=None):
+    if not chat_queue:
+        return []
+    futures = []
+    with ThreadPoolExecutor(max_workers=len(chat_queue)) as executor:
+        for i, chat in enumerate(chat_queue):
+            excluded = set(chat.get("finished_chat_indexes_to_exclude_from_carryover", []))
+            prerequisites = [futures[j] for j in range(i) if j not in excluded]
+            futures.append(executor.submit(run_dependent_chat, chat, prerequisites, budget, stage))
+        return [future.result() for future in futures]
+
+def run_dependent_chat(chat, prerequisites, budget, stage):
+    carryover = chat.get("carryover", [])
+    carryover = [carryover] if isinstance(carryover, str) else list(carryover)
+    carryover += [future.result().summary for future in prerequisites]
+    return call_agent(
+        chat["sender"],
+        chat["recipient"],
+        chat["message"],
+        budget=budget,
+        stage=stage,
+        role=chat.get("role"),
+        max_turns=chat.get("max_turns", 1),
+        summary_method=chat.get("summary_method", "last_msg"),
+        carryover=carryover
+    )
+
+# 单轮时间预算：预算用尽时放弃在途调用，返回当前可用的最佳回答
+class RoundBudgetExceeded(Exception):
+    def __init__(self, stage):
+        super().__init__(f"轮次时间预算在 {stage} 阶段用尽")
+        self.stage = stage
+
+class CallTimeout(TimeoutError):
+    pass
+
+def new_round_budget(seconds):
+    now = time.monotonic()
+    return {"seconds": seconds, "start": now, "deadline": now + seconds if seconds else None, "cut_stage": None, "stages": {}}
+
+def budget_remaining(budget):
+    if not budget or budget["deadline"] is None:
+        return None
+    return budget["deadline"] - time.monotonic()
+
+def check_budget(budget, stage):
+    remaining = budget_remaining(budget)
+    if remaining is not None and (remaining <= 0 or budget["cut_stage"]):
+        if budget["cut_stage"] is None:
+            budget["cut_stage"] = stage
+        raise RoundBudgetExceeded(budget["cut_stage"])
+    return remaining
+
+def mark_stage(budget, stage):
+    if budget:
+        budget["stages"][stage] = round(time.monotonic() - budget["start"], 3)
+
+# 在守护线程中运行调用，超时后不再等待。线程无法强制终止：CustomOllamaClient 的请求在同一截止时间被 HTTP 超时中止，
+# 内置客户端的请求则会继续运行到模型配置的 timeout；调用期间持有的发送方-接收方锁（见 call_agent）在线程真正结束时才释放
+def run_with_timeout(func, timeout, *args, **kwargs):
+    if timeout is None:
+        return func(*args, **kwargs)
+    outcome = {}
+    done = threading.Event()
+
+    def target():
+        try:
+            outcome["result"] = func(*args, **kwargs)
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            done.set()
+
+    threading.Thread(target=target, daemon=True).start()
+    if not done.wait(max(timeout, 0)):
+        raise CallTimeout(f"调用超过 {timeout:.1f} 秒未返回")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+# 同一对发送方与接收方共用 sender._oai_messages[recipient] 这一个列表，autogen 返回的 chat_history 也是它，
+# 新对话开始时会原地清空。超时被放弃的调用若仍在运行，会把迟到的回复写进之后对话的记录，
+# 因此每对代理同时只允许一个调用：锁由运行调用的线程在调用真正结束时释放，重试和下一轮都要先等到它
+pair_locks_lock = threading.Lock()
+
+def pair_lock(sender, recipient):
+    with pair_locks_lock:
+        locks = sender.__dict__.setdefault("_call_pair_locks", {})
+        return locks.setdefault(id(recipient), threading.Lock())
+
+def initiate_chat_locked(lock, role, sender, recipient, message, chat_kwargs, deadline):
+    try:
+        return initiate_chat_as(role, sender, recipient, message, chat_kwargs, deadline)
+    finally:
+        lock.release()
+
+# 统一的 Agent 调用入口：按角色策略超时与带抖动的指数退避重试，并受本轮时间预算约束
+def call_agent(sender, recipient, message, budget=None, stage=None, role=None, **chat_kwargs):
+    role = role or stage or "default"
+    policy = get_call_policy(role)
+    lock = pair_lock(sender, recipient)
+    attempt = 0
+    while True:
+        remaining = check_budget(budget, stage)
+        timeout = policy["timeout"] if remaining is None else min(policy["timeout"] or remaining, remaining)
+        start = time.monotonic()
+        try:
+            if not lock.acquire(timeout=-1 if timeout is None else max(timeout, 0)):
+                count_metric(f"call.{role}.pair_busy")
+                raise CallTimeout("上一次调用仍未结束")
+            deadline = start + timeout if timeout is not None else None
+            result = run_with_timeout(initiate_chat_locked, None if timeout is None else deadline - time.monotonic(), lock, role, sender, recipient, message, chat_kwargs, deadline)
+            observe_metric(f"call.{role}", time.monotonic() - start)
+            count_metric(f"call.{role}.success")
+            return result
+        except CallTimeout as e:
+            remaining = budget_remaining(budget)
+            if remaining is not None and remaining <= 0:
+                count_metric(f"call.{role}.budget_cut")
+                if budget["cut_stage"] is None:
+                    budget["cut_stage"] = stage
+                raise RoundBudgetExceeded(budget["cut_stage"])
+            count_metric(f"call.{role}.timeout")
+            error = e
+        except RoundBudgetExceeded:
+            raise
+        except Exception as e:
+            count_metric(f"call.{role}.error")
+            error = e
+        if attempt >= policy["retries"]:
+            count_metric(f"call.{role}.failed")
+            raise error
+        attempt += 1
+        count_metric(f"call.{role}.retry")
+        delay = policy["backoff"] * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+        remaining = budget_remaining(budget)
+        if remaining is not None:
+            delay = min(delay, max(remaining, 0))
+        print(f"{role} 调用失败（{error}），{delay:.1f} 秒后第 {attempt} 次重试")
+        time.sleep(delay)
+
+# 预算用尽时的回退：取评分最高的流派文本，没有评分时使用通用型输出
+def best_available_text(selected_genres, genre_results, eval_results, general_text):
+    best_text, best_score = None, 0.0
+    for i, genre in enumerate(selected_genres):
+        result = genre_results[i] if i < len(genre_results) else None
+        if not result or not result.chat_history:
+            continue
+        scores = [extract_score(clean_text(entry["content"], remove_think=True)) for entry in (eval_results or {}).get(f"{genre}Agent", [])]
+        score = sum(scores) / len(scores) if scores else 0.0
+        if score > best_score:
+            best_score = score
+            best_text = clean_text(result.chat_history[-1]["content"], remove_think=True)
+    return best_text if best_text else resolve_text(general_text)
+
+# 调用指标：计数器与延迟样本（每项保留最近 1000 个样本）
+metrics_lock = threading.Lock()
+call_metrics = {"counters": {}, "samples": {}}
+
+def count_metric(name, value=1):
+    with metrics_lock:
+        call_metrics["counters"][name] = call_metrics["counters"].get(name, 0) + value
+
+def observe_metric(name, value):
+    with metrics_lock:
+        samples = call_metrics["samples"].setdefault(name, [])
+        samples.append(value)
+        if len(samples) > 1000:
+            del samples[:len(samples) - 1000]
+
+# window 只取最近的若干个样本，用于判断当前负载
+def metric_percentile(name, pct, min_samples=1, window=None):
+    with metrics_lock:
+        samples = sorted(call_metrics["samples"].get(name, [])[-window:] if window else call_metrics["samples"].get(name, []))
+    if len(samples) < min_samples or not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def metrics_summary():
+    with metrics_lock:
+        counters = dict(call_metrics["counters"])
+        names = list(call_metrics["samples"])
+    samples = {}
+    for name in names:
+        samples[name] = {
+            "count": len(call_metrics["samples"][name]),
+            "p50": metric_percentile(name, 50),
+            "p95": metric_percentile(name, 95),
+            "max": metric_percentile(name, 100)
+        }
+    summary = {"counters": counters, "samples": samples}
+    if route_log:
+        summary["routes"] = list(route_log)
+    if warmup_report:
+        summary["warmup"] = list(warmup_report)
+    return summary
+
+# 各角色的调用策略：timeout 单次调用超时（秒），retries 最大重试次数，backoff 退避基数（秒），
+# think_budget 推理模型的思考 token 上限（仅 CustomOllamaClient；None 不限，0 关闭推理），
+# num_predict 生成 token 上限，stop 停止序列列表，early_stop 输出格式完整后提前结束（"score" 或 "genres"，见 early_stop_checks），
+# format 按 JSON schema 约束输出（"score" 或 "genres"，见 output_schemas），num_ctx 上下文长度（token，见 history_context）
+# 角色名形如 "selector"、"genre:CBT"、"evaluator:GoalConsistency"，未单独配置时按冒号前缀、再按 default 取值
+call_policies = {
+    "default": {"timeout": 300, "retries": 2, "backoff": 1.0},
+    "selector": {"timeout": 120, "retries": 2, "backoff": 0.5, "early_stop": "genres"},
+    "general": {"timeout": 180},
+    "genre": {"timeout": 240},
+    "evaluator": {"timeout": 180, "early_stop": "score"},
+    "integrator": {"timeout": 240},
+    "integration_eval": {"timeout": 180, "early_stop": "score"}
+}
+call_context = threading.local()
+
+def load_call_policies(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for role, policy in json.load(f).items():
+            call_policies[role] = {**call_policies.get(role, {}), **policy}
+    print(f"已加载调用策略: {call_policies}")
+
+def get_call_policy(role):
+    policy = dict(call_policies["default"])
+    if role:
+        policy.update(call_policies.get(role.split(":")[0], {}))
+        policy.update(call_policies.get(role, {}))
+    return policy
+
+# 上下文预算：调用策略设置了 num_ctx 时（同时作为 Ollama 的 num_ctx 选项），从最早的轮次开始丢弃对话历史，
+# 使系统提示词、消息其余部分、对话历史与输出保留（num_predict，未设置时为 context_reserve）的估算 token 数不超过 num_ctx，
+# 避免 Ollama 静默截断提示词开头。token 数按将要处理该提示词的模型的每字符 token 数估算：模型校准前为 default_token_ratio，
+# 之后取该模型最近 50 次调用实际 prompt_eval_count 与字符数之比的最大值（命中 KV 缓存时计数偏小，取最大值偏保守）；
+# 可能由多个模型处理时（多个代理或路由的备用模型）取其中最大的比值。实际利用率记为 context.<角色>.utilization
+context_reserve = 512
+context_overhead = 32
+default_token_ratio = 1.0
+token_ratios = {}
+token_ratios_lock = threading.Lock()
+
+def estimate_tokens(text, models=()):
+    with token_ratios_lock:
+        ratio = max((max(token_ratios[model]) if token_ratios.get(model) else default_token_ratio for model in models), default=default_token_ratio)
+    return int(len(text) * ratio) + 1
+
+# 代理按角色路由后可能使用的模型（主模型和备用模型），不记录路由指标
+def prompt_models(role, agents):
+    route = role_route(role)
+    models = set()
+    for agent in agents:
+        models.add(route.get("primary", agent.llm_config["config_list"][0]["model"]))
+        if route.get("fallback"):
+            models.add(route["fallback"])
+    return models
+
+# 提示词被截断（prompt_eval_count 达到 num_ctx）时的样本不参与校准
+def calibrate_tokens(model, chars, prompt_tokens, num_ctx=None):
+    if not chars or not prompt_tokens or (num_ctx and prompt_tokens >= num_ctx):
+        return
+    with token_ratios_lock:
+        token_ratios.setdefault(model, deque(maxlen=50)).append(prompt_tokens / chars)
+
+def context_limit(role):
+    policy = get_call_policy(role)
+    if not policy.get("num_ctx"):
+        return None
+    return policy["num_ctx"] - (policy.get("num_predict") or context_reserve) - context_overhead
+
+# 拼接对话历史；fixed 为同一条消息中的其余部分（任务、待评估文本、反馈等），agents 为将要接收该消息的代理
+def history_context(conversation_history, role, system_message="", fixed="", agents=()):
+    entries = [f"用户: {clean_text(entry['task'])}\n框架: {clean_text(entry['result'], remove_think=True)}" for entry in conversation_history]
+    limit = context_limit(role)
+    if limit is None:
+        return "\n".join(entries)
+    models = prompt_models(role, agents)
+    available = limit - estimate_tokens(system_message + fixed, models)
+    kept, used = [], 0
+    for entry in reversed(entries):
+        cost = estimate_tokens(entry + "\n", models)
+        if used + cost > available:
+            break
+        kept.append(entry)
+        used += cost
+    observe_metric(f"context.{role}.history_tokens", used)
+    if len(kept) < len(entries):
+        count_metric(f"context.{role}.trimmed")
+        print(f"{role} 的提示词超出上下文预算，丢弃最早的 {len(entries) - len(kept)} 轮对话历史")
+    if available < 0:
+        count_metric(f"context.{role}.over_budget")
+        print(f"{role} 的消息本身已超出上下文预算（约 {limit - available} token，预算 {limit}）")
+    return "\n".join(reversed(kept))
+
+# 返回的 chat_history 是共享消息列表的副本，之后同一对代理的对话原地清空或追加时不影响已返回的结果
+def initiate_chat_as(role, sender, recipient, message, chat_kwargs, deadline=None):
+    call_context.role = role
+    call_context.deadline = deadline
+    try:
+        result = sender.initiate_chat(recipient, message=message, **chat_kwargs)
+        result.chat_history = [dict(entry) for entry in result.chat_history]
+        return result
+    finally:
+        call_context.role = None
+        call_context.deadline = None
 
 # 选择器逻辑
-def selector_function(task, chat_history, conversation_history, selector_state, round_num):
+def parse_selector_reply(reply):
+    reply = reply.rstrip('。').strip()
+    selected_genres_cn = [genre.strip() for genre in reply.split("、") if genre.strip()]
+    if not selected_genres_cn:
+        selected_genres_cn = [reply.strip()] if reply.strip() in genre_mapping else []
+    return selected_genres_cn
+
+def selector_function(task, chat_history, conversation_history, selector_state, round_num, budget=None, sender=None):
     task = clean_text(task)
+    sender = sender or user_proxy
     if round_num <= 4:
         print(f"前4轮使用全部流派: {all_genres}")
         return all_genres
     if selector_state["selector_active"]:
-        context = "\n".join([f"用户: {clean_text(entry['task'])}\n框架: {clean_text(entry['result'], remove_think=True)}" for entry in conversation_history])
+        context = history_context(conversation_history, "selector", selector.system_message, task, [selector])
         message = f"之前的对话历史：\n{context}\n\n根据当前任务选择1-2个流派Agent：\n{task}" if conversation_history else f"根据任务选择1-2个流派Agent：\n{task}"
         try:
-            chat_result = user_proxy.initiate_chat(selector, message=message, max_turns=1)
+            chat_result = call_agent(sender, selector, message, budget=budget, stage="selector", role="selector", max_turns=1)
             reply = clean_text(chat_result.chat_history[-1]["content"])
             print(f"选择器原始输出: {reply}")
-            reply = reply.rstrip('。').strip()
-            selected_genres_cn = [genre.strip() for genre in reply.split("、") if genre.strip()]
-            if not selected_genres_cn:
-                selected_genres_cn = [reply.strip()] if reply.strip() in genre_mapping else []
+            selected_genres_cn = parse_selector_reply(reply)
             print(f"提取的中文流派: {selected_genres_cn}")
             selected_genres = [genre_mapping.get(genre) for genre in selected_genres_cn if genre_mapping.get(genre)]
             print(f"映射后的流派: {selected_genres}")
@@ -975,6 +2113,8 @@ def selector_function(task, chat_history, conversation_history, selector_state,
             selector_state["selector_active"] = False
             selector_state["inactive_rounds"] = 3
             return selected_genres
+        except RoundBudgetExceeded:
+            raise
         except Exception as e:
             print(f"选择器运行出错: {e}, 使用上次流派或全部流派")
             return selector_state["last_selected_genres"] or all_genres
@@ -986,37 +2126,45 @@ def selector_function(task, chat_history, conversation_history, selector_state,
         return selector_state["last_selected_genres"]
 
 # 通用型 Agent 逻辑
-def run_general_agent(task, chat_history, conversation_history):
+def run_general_agent(task, chat_history, conversation_history, budget=None, sender=None):
     task = clean_text(task)
-    context = "\n".join([f"用户: {clean_text(entry['task'])}\n框架: {clean_text(entry['result'], remove_think=True)}" for entry in conversation_history])
+    sender = sender or user_proxy
+    context = history_context(conversation_history, "general", general_agent.system_message, task, [general_agent])
     message = f"之前的对话历史：\n{context}\n\n当前任务：\n{task}" if conversation_history else f"当前任务：\n{task}"
     try:
-        chat_result = user_proxy.initiate_chat(general_agent, message=message, max_turns=1, summary_method="last_msg")
+        chat_result = call_agent(sender, general_agent, message, budget=budget, stage="general", role="general", max_turns=1, summary_method="last_msg")
         if chat_result.chat_history and "content" in chat_result.chat_history[-1]:
             chat_result.chat_history[-1]["content"] = clean_text(chat_result.chat_history[-1]["content"], remove_think=True)
         print(f"通用型 Agent 生成结果: {chat_result.chat_history}")
         chat_history["general"] = chat_history.get("general", []) + chat_result.chat_history
         return chat_result
+    except RoundBudgetExceeded:
+        raise
     except Exception as e:
         print(f"通用型 Agent 运行出错: {e}")
         return None
 
 # 流派 Agent 并行生成
-def run_genre_agents(selected_genres, task, chat_history, conversation_history):
+def run_genre_agents(selected_genres, task, chat_history, conversation_history, budget=None, sender=None):
     task = clean_text(task)
+    sender = sender or user_proxy
     valid_genres = [genre for genre in selected_genres if genre in genre_agents]
     if not valid_genres:
         print("错误：没有有效的流派名称，跳过生成。")
         return []
-    context = "\n".join([f"用户: {clean_text(entry['task'])}\n框架: {clean_text(entry['result'], remove_think=True)}" for entry in conversation_history])
+    context = history_context(conversation_history, "genre", max((genre_agents[genre].system_message for genre in valid_genres), key=len), task, [genre_agents[genre] for genre in valid_genres])
     message = f"之前的对话历史：\n{context}\n\n当前任务：\n{task}" if conversation_history else f"当前任务：\n{task}"
     results = []
     for genre in valid_genres:
         agent = genre_agents[genre]
         try:
-            chat_result = user_proxy.initiate_chat(
-                recipient=agent,
-                message=message,
+            chat_result = call_agent(
+                sender,
+                agent,
+                message,
+                budget=budget,
+                stage="genres",
+                role=f"genre:{genre}",
                 max_turns=1,
                 summary_method="last_msg",
                 clear_history=True
@@ -1033,6 +2181,11 @@ def run_genre_agents(selected_genres, task, chat_history, conversation_history):
                 print(f"流派 {genre}: 无有效输出")
                 chat_history[f"genre_{genre}"] = [{"content": "无有效输出", "role": "assistant", "name": f"{genre}Agent"}]
             results.append(chat_result)
+        except RoundBudgetExceeded:
+            print(f"流派 {genre} 因时间预算用尽未生成")
+            chat_history[f"genre_{genre}"] = [{"content": "时间预算用尽，未生成", "role": "assistant", "name": f"{genre}Agent"}]
+            results.extend([None] * (len(valid_genres) - len(results)))
+            break
         except Exception as e:
             print(f"流派 {genre} 运行出错: {e}")
             chat_history[f"genre_{genre}"] = [{"content": f"生成失败: {str(e)}", "role": "assistant", "name": f"{genre}Agent"}]
@@ -1040,11 +2193,12 @@ def run_genre_agents(selected_genres, task, chat_history, conversation_history):
     return results
 
 # 评估器逻辑
-def run_evaluators(results, chat_history, task, conversation_history, genres):
+def run_evaluators(results, chat_history, task, conversation_history, genres, budget=None, sender=None):
     task = clean_text(task)
+    sender = sender or user_proxy
     eval_results = {}
-    context = "\n".join([f"用户: {clean_text(entry['task'])}\n框架: {clean_text(entry['result'], remove_think=True)}" for entry in conversation_history])
     evaluators = create_evaluators(genres, include_general="General" in genres)
+    evaluator_system_message = max((evaluator.system_message for evaluator in evaluators.values()), key=len)
     print(f"生成的评估器: {list(evaluators.keys())}")
     for i, result in enumerate(results):
         genre_name = f"Genre_{i}"
@@ -1076,6 +2230,7 @@ def run_evaluators(results, chat_history, task, conversation_history, genres):
             ]
             continue
         text = clean_text(result.chat_history[-1]["content"], remove_think=True)
+        context = history_context(conversation_history, "evaluator", evaluator_system_message, task + text, evaluators.values())
         base_message = (
             f"之前的对话历史：\n{context}\n\n当前用户任务：\n{task}\n\n评估以下 {'通用型 Agent' if genre_name == 'GeneralAgent' else genre_name + ' 流派'} 生成的文本：\n{text}"
             if conversation_history else
@@ -1086,14 +2241,14 @@ def run_evaluators(results, chat_history, task, conversation_history, genres):
             theo_key = f"TheoreticalCoherence_{genres[i]}"
             theo_evaluator = evaluators[theo_key]
             print(f"评估 {genre_name} 的 {theo_key}")
-            theo_result = user_proxy.initiate_chat(theo_evaluator, message=base_message, max_turns=1, clear_history=True)
+            theo_result = call_agent(sender, theo_evaluator, base_message, budget=budget, stage="evaluators", role="evaluator:TheoreticalCoherence", max_turns=1, clear_history=True)
             theo_content = theo_result.chat_history[-1]["content"]
             theo_cleaned = clean_text(theo_content, remove_think=True)
             theo_score = extract_score(theo_cleaned)
             chat_history[f"evaluator_{genre_name}"].append(copy.deepcopy(theo_result.chat_history))
             goal_evaluator = evaluators["GoalConsistency"]
             print(f"评估 {genre_name} 的 GoalConsistency")
-            goal_result = user_proxy.initiate_chat(goal_evaluator, message=base_message, max_turns=1, clear_history=True)
+            goal_result = call_agent(sender, goal_evaluator, base_message, budget=budget, stage="evaluators", role="evaluator:GoalConsistency", max_turns=1, clear_history=True)
             goal_content = goal_result.chat_history[-1]["content"]
             goal_cleaned = clean_text(goal_content, remove_think=True)
             goal_score = extract_score(goal_cleaned)
@@ -1101,7 +2256,7 @@ def run_evaluators(results, chat_history, task, conversation_history, genres):
             tech_evaluator = evaluators["TechniqueCompatibility"]
             tech_message = f"{base_message}\n\n参考评分：\n- 理论连贯性: {theo_score}分\n- 目标一致性: {goal_score}分"
             print(f"评估 {genre_name} 的 TechniqueCompatibility")
-            tech_result = user_proxy.initiate_chat(tech_evaluator, message=tech_message, max_turns=1, clear_history=True)
+            tech_result = call_agent(sender, tech_evaluator, tech_message, budget=budget, stage="evaluators", role="evaluator:TechniqueCompatibility", max_turns=1, clear_history=True)
             tech_content = tech_result.chat_history[-1]["content"]
             tech_cleaned = clean_text(tech_content, remove_think=True)
             tech_score = extract_score(tech_cleaned)
@@ -1111,6 +2266,9 @@ def run_evaluators(results, chat_history, task, conversation_history, genres):
                 {"content": goal_content, "role": "assistant"},
                 {"content": tech_content, "role": "assistant"}
             ]
+        except RoundBudgetExceeded:
+            print(f"评估 {genre_name} 时时间预算用尽，停止评估")
+            break
         except Exception as e:
             print(f"评估 {genre_name} 时出错: {e}")
             eval_results[genre_name] = [
@@ -1135,10 +2293,13 @@ def run_evaluators(results, chat_history, task, conversation_history, genres):
     return eval_results
 
 # 整合逻辑
-def integrate_results(selected_genres, genre_results, eval_results, chat_history, general_text, round_num, task):
+def integrate_results(selected_genres, genre_results, eval_results, chat_history, general_text, round_num, task, budget=None, conversation_history=None, manager=None):
     task = clean_text(task)
+    conversation_history = conversation_history or []
+    manager = manager or integration_manager
     if round_num <= 4:
         if not genre_results or not eval_results:
+            general_text = resolve_text(general_text)
             chat_history["integration"] = [{"content": f"全部流派失败，使用通用型 Agent 输出：{general_text}", "role": "assistant", "name": "IntegrationManager"}]
             return general_text
         max_goal_score = 0
@@ -1162,16 +2323,19 @@ def integrate_results(selected_genres, genre_results, eval_results, chat_history
             chat_history["integration"] = [{"content": f"选择 GoalConsistency 最高分流派（{selected_genres[best_genre_idx]}）：{best_text}", "role": "assistant", "name": "IntegrationManager"}]
             return best_text
         else:
+            general_text = resolve_text(general_text)
             chat_history["integration"] = [{"content": f"所有流派 GoalConsistency 低于阈值，使用通用型 Agent 输出：{general_text}", "role": "assistant", "name": "IntegrationManager"}]
             return general_text
     if len(selected_genres) == 1:
         if not genre_results or not genre_results[0] or not genre_results[0].chat_history:
+            general_text = resolve_text(general_text)
             chat_history["integration"] = [{"content": f"单一流派失败，使用通用型 Agent 输出：{general_text}", "role": "assistant", "name": "IntegrationManager"}]
             return general_text
         final_text = clean_text(genre_results[0].chat_history[-1]["content"], remove_think=True)
         chat_history["integration"] = [{"content": f"单一流派（{selected_genres[0]}）结果：{final_text}", "role": "assistant", "name": "IntegrationManager"}]
         return final_text
     if not eval_results:
+        general_text = resolve_text(general_text)
         chat_history["integration"] = [{"content": f"评估失败，使用通用型 Agent 输出：{general_text}", "role": "assistant", "name": "IntegrationManager"}]
         return general_text
     text1 = clean_text(genre_results[0].chat_history[-1]["content"], remove_think=True) if genre_results and genre_results[0] and genre_results[0].chat_history else "无文本"
@@ -1184,9 +2348,12 @@ def integrate_results(selected_genres, genre_results, eval_results, chat_history
         else:
             scores[genre] = 0
             print(f"警告：流派 {genre_name} 评估不完整，分数设为 0")
-    context = "\n".join([f"用户: {clean_text(entry['task'])}\n框架: {clean_text(entry['result'], remove_think=True)}" for entry in conversation_history])
+    context = history_context(conversation_history, "integrator", text_integrator.system_message, f"{task}{text1}{text2}{scores}", [text_integrator])
     initial_message = f"之前的对话历史：\n{context}\n\n当前用户任务：\n{task}\n\n整合以下两个流派文本：\n1. {text1}\n2. {text2}\n评分: {scores}"
 
+    def budget_fallback():
+        return best_available_text(selected_genres, genre_results, eval_results, general_text)
+
     def nested_integration(manager, integrator, evaluators, initial_message, chat_history):
         versions = []
         current_text = None
@@ -1197,18 +2364,23 @@ def integrate_results(selected_genres, genre_results, eval_results, chat_history
                 message_to_integrator = initial_message
             else:
                 feedback = "\n".join([f"{key}: {eval_result['score']}分, 修改意见: {eval_result['suggestion']}" for key, eval_result in last_eval_results.items()])
+                context = history_context(conversation_history, "integrator", integrator.system_message, f"{task}{current_text}{text1}{text2}{feedback}", [integrator])
                 message_to_integrator = f"之前的对话历史：\n{context}\n\n当前用户任务：\n{task}\n\n之前整合的文本：\n{current_text}\n\n流派文本：\n1. {text1}\n2. {text2}\n\n评估反馈：\n{feedback}\n\n请根据以上信息优化整合文本。"
             try:
-                integration_result = manager.initiate_chat(integrator, message=message_to_integrator, max_turns=1)
+                integration_result = call_agent(manager, integrator, message_to_integrator, budget=budget, stage="integration", role="integrator", max_turns=1)
                 current_text = clean_text(integration_result.chat_history[-1]["content"], remove_think=True)
-                chat_history[f"integration_text_iter_{iteration+1}"] = integration_result.chat_history
-                eval_message = f"之前的对话历史：\n{context}\n\n当前用户任务：\n{task}\n\n评估以下整合文本：\n{current_text}" if conversation_history else f"当前用户任务：\n{task}\n\n评估以下整合文本：\n{current_text}"
+                chat_history[f"integration_text_iter_{iteration+1}"] = copy.deepcopy(integration_result.chat_history)
+                eval_context = history_context(conversation_history, "integration_eval", max((evaluator.system_message for evaluator in evaluators.values()), key=len), task + current_text, evaluators.values())
+                eval_message = f"之前的对话历史：\n{eval_context}\n\n当前用户任务：\n{task}\n\n评估以下整合文本：\n{current_text}" if conversation_history else f"当前用户任务：\n{task}\n\n评估以下整合文本：\n{current_text}"
                 eval_queue = [
-                    {"sender": manager, "recipient": evaluator, "message": eval_message, "max_turns": 1, "summary_method": "last_msg"}
-                    for evaluator in evaluators.values()
+                    {"sender": manager, "recipient": evaluator, "message": eval_message, "max_turns": 1, "summary_method": "last_msg", "role": f"integration_eval:{key}"}
+                    for key, evaluator in evaluators.items()
                 ]
-                eval_results = autogen.initiate_chats(eval_queue)
-                chat_history[f"integration_eval_iter_{iteration+1}"] = [result.chat_history for result in eval_results]
+                if parallel_integration_eval:
+                    for i, chat in enumerate(eval_queue):
+                        chat["finished_chat_indexes_to_exclude_from_carryover"] = list(range(i))
+                eval_results = run_chats_concurrently(eval_queue, budget=budget, stage="integration")
+                chat_history[f"integration_eval_iter_{iteration+1}"] = [copy.deepcopy(result.chat_history) for result in eval_results]
                 last_eval_results = {}
                 for i, (key, evaluator) in enumerate(evaluators.items()):
                     eval_text = eval_results[i].chat_history[-1]["content"]
@@ -1220,133 +2392,747 @@ def integrate_results(selected_genres, genre_results, eval_results, chat_history
                 if avg_score >= threshold:
                     chat_history["integration_final"] = [{"content": f"最终整合文本：{current_text} (平均分数: {avg_score})", "role": "assistant", "name": "IntegrationManager"}]
                     return current_text
+            except RoundBudgetExceeded:
+                print(f"整合迭代 {iteration+1} 时时间预算用尽，停止迭代")
+                break
             except Exception as e:
                 print(f"整合迭代 {iteration+1} 出错: {e}")
                 continue
-        best_version = max(versions, key=lambda x: x["avg_score"]) if versions else {"text": general_text, "avg_score": 0}
+        if versions:
+            best_version = max(versions, key=lambda x: x["avg_score"])
+        elif budget and budget["cut_stage"]:
+            best_version = {"text": budget_fallback(), "avg_score": 0}
+        else:
+            best_version = {"text": resolve_text(general_text), "avg_score": 0}
         chat_history["integration_final"] = [{"content": f"达到最大迭代次数，最终选择最高分版本：{best_version['text']} (平均分数: {best_version['avg_score']})", "role": "assistant", "name": "IntegrationManager"}]
         return best_version["text"]
 
     try:
-        final_text = nested_integration(integration_manager, text_integrator, integration_evaluators, initial_message, chat_history)
+        final_text = nested_integration(manager, text_integrator, integration_evaluators, initial_message, chat_history)
         return final_text
     except Exception as e:
         print(f"整合过程出错: {e}")
+        general_text = resolve_text(general_text)
         chat_history["integration"] = [{"content": f"整合失败，使用通用型 Agent 输出：{general_text}", "role": "assistant", "name": "IntegrationManager"}]
         return general_text
 
-# 测试主流程
-def run_test(data_dir, output_dir):
-    global all_chat_history, conversation_history, selector_state
-    os.makedirs(output_dir, exist_ok=True)
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    chat_file = f"{output_dir}/test_chat_history_{timestamp}.json"
-    results_file = f"{output_dir}/test_results_{timestamp}.json"
+# 通用型 Agent 与选择器互不依赖：parallel_general_selector 为 True 时两者同时运行，在流派阶段前汇合；
+# 通用型的记录先写入暂存字典，汇合后再并入本轮记录，避免两个线程同时写同一个字典
+parallel_general_selector = True
 
-    # 获取所有 JSON 文件
-    json_files = [f for f in os.listdir(data_dir) if f.endswith(".json")]
-    if not json_files:
-        print(f"错误：{data_dir} 中没有 JSON 文件")
-        return
+# 推测执行通用型 Agent：与选择器、流派阶段同时运行，结果只在回退路径上等待（resolve_text）；
+# 本轮结束时仍未完成的调用被取消（尚未开始）或放弃等待（已在运行），其输出不写入聊天记录。
+# 后台调用使用本轮专用的发送方，被放弃的调用不会与下一轮共用 general_agent 的消息列表和调用锁，结束后释放其记录
+speculative_general = False
+general_executor = ThreadPoolExecutor(max_workers=8)
 
-    test_results = []
-    for idx, json_file in enumerate(json_files):
-        file_path = os.path.join(data_dir, json_file)
-        print(f"\n处理第 {idx+1} 个 JSON 文件: {json_file}")
-        current_chat_history = {}
-        conversation_history = []  # 每条数据独立对话历史
-        selector_state = {"last_selected_genres": [], "inactive_rounds": 0, "selector_active": True}
-        round_num = 1
-
-        # 读取单个 JSON 文件
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                dialogue = json.load(f)
-            print(f"成功加载对话数据：{dialogue}")
-        except Exception as e:
-            print(f"读取 {json_file} 出错: {e}")
+def speculate_general(task, staging, conversation_history, budget=None):
+    sender = new_sender()
+    try:
+        general_result = run_general_agent(task, staging, conversation_history, budget=budget, sender=sender)
+    except RoundBudgetExceeded:
+        return "通用型 Agent 无输出"
+    finally:
+        release_session_agents({"user_proxy": sender})
+    return clean_text(general_result.chat_history[-1]["content"], remove_think=True) if general_result and general_result.chat_history else "通用型 Agent 无输出"
+
+# 回退路径取通用型输出：推测执行时等待其完成
+def resolve_text(value):
+    if not isinstance(value, Future):
+        return value
+    count_metric("speculative.general.used")
+    start = time.monotonic()
+    try:
+        return value.result()
+    except Exception as e:
+        print(f"通用型 Agent 推测执行出错: {e}")
+        return "通用型 Agent 无输出"
+    finally:
+        observe_metric("speculative.general.wait", time.monotonic() - start)
+
+# 本轮结束：已完成的推测结果写入聊天记录（保持 general 在最前），未完成的取消或放弃
+def finish_speculation(future, staging, round_chat_history):
+    if future.done():
+        if not future.cancelled():
+            count_metric("speculative.general.done")
+        general = staging.get("general", [])
+    else:
+        count_metric("speculative.general.cancelled" if future.cancel() else "speculative.general.abandoned")
+        general = [{"content": "通用型 Agent 推测执行未完成，本轮未使用", "role": "assistant", "name": "GeneralAgent"}]
+    merge_general(round_chat_history, general)
+
+def merge_general(round_chat_history, general):
+    rest = dict(round_chat_history)
+    round_chat_history.clear()
+    round_chat_history["general"] = general
+    round_chat_history.update(rest)
+
+# 从已保存的轮次记录恢复通用型输出、所选流派、流派结果和评估结果（阶段重放与近似重复缓存共用）；
+# 流派记录只有一条消息时是失败占位，对应原流程中的 None
+def restore_stage_results(stored_round):
+    general_text = clean_text(stored_round["general"][-1]["content"], remove_think=True) if stored_round.get("general") else "通用型 Agent 无输出"
+    selected_genres = [key[len("genre_"):] for key in stored_round if key.startswith("genre_")]
+    genre_results = []
+    for genre in selected_genres:
+        stored = stored_round[f"genre_{genre}"]
+        if len(stored) < 2:
+            genre_results.append(None)
             continue
+        chat_history = copy.deepcopy(stored)
+        chat_history[-1]["content"] = clean_text(chat_history[-1]["content"], remove_think=True)
+        genre_results.append(SimpleNamespace(chat_history=chat_history))
+    eval_results = {
+        key[len("evaluator_"):]: [{"content": transcript[-1]["content"], "role": "assistant"} for transcript in transcripts]
+        for key, transcripts in stored_round.items() if key.startswith("evaluator_")
+    }
+    return general_text, selected_genres, genre_results, eval_results
+
+# 近似重复缓存：开场几轮（round_num <= max_rounds）的任务常是措辞略有不同的问候或常见困扰，精确匹配无法命中。
+# 以规范化任务文本（去掉标点空白、小写）的字符 2-gram MinHash 签名为键，另以历史轮数和之前各轮任务的 MinHash 作为历史指纹；
+# 相似度取签名相同位置的比例（估计 Jaccard 相似度），任务与历史的相似度都不低于 threshold 时命中，
+# 复用已完成轮次的通用型、流派和评估输出，只重新运行整合（前 4 轮的整合不调用模型），命中来源记入 round_chat_history["near_cache"]。
+# 被时间预算截断、通用型未完成或由缓存提供的轮次不写入缓存。由 --near_cache_threshold 开启，仅保存在本进程内存中
+minhash_seeds = [int.from_bytes(hashlib.blake2b(str(i).encode("utf-8"), digest_size=8).digest(), "big") for i in range(64)]
+
+def minhash(text):
+    text = re.sub(r'[\W_]+', '', clean_text(text).lower())
+    grams = [int.from_bytes(hashlib.blake2b(text[i:i + 2].encode("utf-8"), digest_size=8).digest(), "big") for i in range(max(len(text) - 1, 1))]
+    return tuple(min(gram ^ seed for gram in grams) for seed in minhash_seeds)
+
+def minhash_similarity(a, b):
+    return sum(x == y for x, y in zip(a, b)) / len(minhash_seeds)
+
+class NearDuplicateCache:
+    def __init__(self, threshold, max_rounds=2, size=5000):
+        self.threshold = threshold
+        self.max_rounds = max_rounds
+        self.entries = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def _fingerprint(self, task, conversation_history):
+        return minhash(task), len(conversation_history), minhash("\n".join(entry["task"] for entry in conversation_history))
+
+    def lookup(self, task, round_num, conversation_history):
+        if round_num > self.max_rounds:
+            return None
+        task_hash, turns, history_hash = self._fingerprint(task, conversation_history)
+        best, best_similarity = None, 0.0
+        with self.lock:
+            for entry in self.entries:
+                if entry["turns"] != turns:
+                    continue
+                similarity = min(minhash_similarity(task_hash, entry["task_hash"]), minhash_similarity(history_hash, entry["history_hash"]))
+                if similarity >= self.threshold and similarity > best_similarity:
+                    best, best_similarity = entry, similarity
+        if best is None:
+            count_metric("near_cache.miss")
+            return None
+        count_metric("near_cache.hit")
+        observe_metric("near_cache.similarity", best_similarity)
+        return best, best_similarity
+
+    def add(self, task, round_num, conversation_history, round_chat_history):
+        if round_num > self.max_rounds or "near_cache" in round_chat_history or round_chat_history.get("budget", {}).get("cut_stage"):
+            return
+        if len(round_chat_history.get("general", [])) < 2 or not any(key.startswith("genre_") for key in round_chat_history):
+            return
+        stored = {key: copy.deepcopy(value) for key, value in round_chat_history.items() if key in ("general", "selector") or key.startswith(("genre_", "evaluator_"))}
+        task_hash, turns, history_hash = self._fingerprint(task, conversation_history)
+        with self.lock:
+            self.entries.append({"task": task, "task_hash": task_hash, "turns": turns, "history_hash": history_hash, "round": stored})
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "threshold": self.threshold, "max_rounds": self.max_rounds}
+
+near_cache = None
+
+def serve_near_cache(hit, task, round_num, round_chat_history, conversation_history, budget=None, manager=None):
+    entry, similarity = hit
+    print(f"第 {round_num} 轮命中近似重复缓存（相似度 {similarity:.2f}）：{entry['task']}")
+    round_chat_history.update(copy.deepcopy(entry["round"]))
+    round_chat_history["near_cache"] = {"task": entry["task"], "similarity": round(similarity, 3)}
+    general_text, selected_genres, genre_results, eval_results = restore_stage_results(entry["round"])
+    try:
+        return integrate_results(selected_genres, genre_results, eval_results, round_chat_history, general_text, round_num, task, budget=budget, conversation_history=conversation_history, manager=manager)
+    except RoundBudgetExceeded as e:
+        print(f"时间预算用尽（{e.stage} 阶段被截断），输出当前最佳回答")
+        return best_available_text(selected_genres, genre_results, eval_results, general_text)
+
+# 单轮流程：通用型 ∥ 选择器 → 流派 → 评估 → 整合；round_budget 为本轮时间预算（秒），None 表示不限
+def run_round(task, round_num, round_chat_history, conversation_history, selector_state, round_budget=None, agents=None):
+    budget = new_round_budget(round_budget)
+    sender = agents["user_proxy"] if agents else user_proxy
+    manager = agents["integration_manager"] if agents else integration_manager
+    general_text = "通用型 Agent 无输出"
+    general_future, general_staging = None, {}
+    selected_genres, genre_results, eval_results = [], [], {}
+    hit = near_cache.lookup(task, round_num, conversation_history) if near_cache is not None else None
+    if hit:
+        final_result = serve_near_cache(hit, task, round_num, round_chat_history, conversation_history, budget=budget, manager=manager)
+        round_chat_history["final_result"] = final_result
+        return final_result
+    try:
+        # 运行通用型 Agent（并行或推测执行时提交到后台，与选择器同时运行）
+        if speculative_general or parallel_general_selector:
+            general_future = general_executor.submit(speculate_general, task, general_staging, conversation_history, budget)
+            general_text = general_future
+        else:
+            general_result = run_general_agent(task, round_chat_history, conversation_history, budget=budget, sender=sender)
+            general_text = clean_text(general_result.chat_history[-1]["content"], remove_think=True) if general_result and general_result.chat_history else "通用型 Agent 无输出"
+            mark_stage(budget, "general")
+
+        # 选择流派
+        selected_genres = selector_function(task, round_chat_history, conversation_history, selector_state, round_num, budget=budget, sender=sender)
+        print(f"选择的流派: {selected_genres}")
+        mark_stage(budget, "selector")
+
+        # 非推测执行时在流派阶段前等待通用型 Agent
+        if general_future is not None and not speculative_general:
+            general_text = general_future.result()
+            merge_general(round_chat_history, general_staging.get("general", []))
+            general_future = None
+            mark_stage(budget, "general")
+
+        # 运行流派 Agents 和整合
+        final_result = general_text
+        if selected_genres:
+            genre_results = run_genre_agents(selected_genres, task, round_chat_history, conversation_history, budget=budget, sender=sender)
+            mark_stage(budget, "genres")
+            if genre_results and any(result for result in genre_results):
+                check_budget(budget, "evaluators")
+                eval_results = run_evaluators(genre_results, round_chat_history, task, conversation_history, selected_genres, budget=budget, sender=sender)
+                mark_stage(budget, "evaluators")
+                check_budget(budget, "integration")
+                final_result = integrate_results(selected_genres, genre_results, eval_results, round_chat_history, general_text, round_num, task, budget=budget, conversation_history=conversation_history, manager=manager)
+                mark_stage(budget, "integration")
+            else:
+                print("流派 Agent 运行失败，使用通用型 Agent 输出")
+                final_result = resolve_text(final_result)
+                round_chat_history["final"] = [{"content": f"直接输出通用型结果：{final_result} (流派 Agent 运行失败)", "role": "assistant"}]
+        else:
+            print("未选择流派，使用通用型 Agent 输出")
+            final_result = resolve_text(final_result)
+            round_chat_history["final"] = [{"content": f"直接输出通用型结果：{final_result} (未选择流派)", "role": "assistant"}]
+    except RoundBudgetExceeded as e:
+        final_result = best_available_text(selected_genres, genre_results, eval_results, general_text)
+        print(f"时间预算用尽（{e.stage} 阶段被截断），输出当前最佳回答")
+        round_chat_history["final"] = [{"content": f"时间预算用尽，{e.stage} 阶段被截断，输出当前最佳回答：{final_result}", "role": "assistant"}]
+
+    if general_future is not None:
+        finish_speculation(general_future, general_staging, round_chat_history)
+    if round_budget:
+        round_chat_history["budget"] = {"seconds": round_budget, "elapsed": round(time.monotonic() - budget["start"], 3), "cut_stage": budget["cut_stage"], "stages": budget["stages"]}
+    if near_cache is not None:
+        near_cache.add(task, round_num, conversation_history, round_chat_history)
+    round_chat_history["final_result"] = final_result
+    return final_result
+
+# 阶段重放：复用已保存轮次中的通用型、选择器和流派输出，从 from_stage 开始重新运行下游阶段。
+# from_stage 为 evaluators 时重新评估并整合，为 integration 时还复用已保存的评估结果，只重新整合
+replay_stages = ["evaluators", "integration"]
+
+def replay_round(task, round_num, stored_round, round_chat_history, conversation_history, from_stage="evaluators", round_budget=None, agents=None):
+    budget = new_round_budget(round_budget)
+    sender = agents["user_proxy"] if agents else user_proxy
+    manager = agents["integration_manager"] if agents else integration_manager
+    for key, value in stored_round.items():
+        if key in ("general", "selector") or key.startswith("genre_") or (from_stage == "integration" and key.startswith("evaluator_")):
+            round_chat_history[key] = value
+    round_chat_history["replay"] = {"from_stage": from_stage}
+    general_text, selected_genres, genre_results, stored_eval_results = restore_stage_results(stored_round)
+    eval_results = {}
 
-        # 提取求助者提问
-        user_messages = [msg for msg in dialogue if msg.startswith("求助者：")]
-        if not user_messages:
-            print(f"警告：{json_file} 无求助者提问，跳过")
+    final_result = general_text
+    try:
+        if not selected_genres:
+            round_chat_history["final"] = [{"content": f"直接输出通用型结果：{final_result} (未选择流派)", "role": "assistant"}]
+        elif not any(genre_results):
+            round_chat_history["final"] = [{"content": f"直接输出通用型结果：{final_result} (流派 Agent 运行失败)", "role": "assistant"}]
+        else:
+            if from_stage == "integration":
+                eval_results = stored_eval_results
+            else:
+                eval_results = run_evaluators(genre_results, round_chat_history, task, conversation_history, selected_genres, budget=budget, sender=sender)
+                mark_stage(budget, "evaluators")
+            check_budget(budget, "integration")
+            final_result = integrate_results(selected_genres, genre_results, eval_results, round_chat_history, general_text, round_num, task, budget=budget, conversation_history=conversation_history, manager=manager)
+            mark_stage(budget, "integration")
+    except RoundBudgetExceeded as e:
+        final_result = best_available_text(selected_genres, genre_results, eval_results, general_text)
+        print(f"时间预算用尽（{e.stage} 阶段被截断），输出当前最佳回答")
+        round_chat_history["final"] = [{"content": f"时间预算用尽，{e.stage} 阶段被截断，输出当前最佳回答：{final_result}", "role": "assistant"}]
+
+    if round_budget:
+        round_chat_history["budget"] = {"seconds": round_budget, "elapsed": round(time.monotonic() - budget["start"], 3), "cut_stage": budget["cut_stage"], "stages": budget["stages"]}
+    round_chat_history["final_result"] = final_result
+    return final_result
+
+# 重放一条已保存的测试结果；下游阶段看到的对话历史使用重放后的新回答
+def replay_dialogue(idx, record, from_stage="evaluators", round_budget=None, agents=None):
+    print(f"\n重放第 {idx+1} 条对话: {record['file_name']}（从 {from_stage} 阶段开始）")
+    current_chat_history = {}
+    conversation_history = []
+    dialogue_history = []
+    for round_num, turn in enumerate(record["dialogue"], 1):
+        stored_round = record["chat_history"].get(f"round_{round_num}")
+        if stored_round is None:
+            print(f"警告：第 {round_num} 轮没有保存的记录，停止重放")
+            break
+        task = turn["user"]
+        print(f"重放任务：{task}")
+        current_chat_history[f"round_{round_num}"] = {}
+        final_result = replay_round(task, round_num, stored_round, current_chat_history[f"round_{round_num}"], conversation_history, from_stage=from_stage, round_budget=round_budget, agents=agents)
+        conversation_history.append({"task": task, "result": final_result})
+        dialogue_history.append({"user": task, "assistant": final_result})
+    return {
+        "test_id": idx + 1,
+        "file_name": record["file_name"],
+        "dialogue": dialogue_history,
+        "chat_history": current_chat_history
+    }
+
+# 轮次检查点：以 (数据名称, 轮次, 当前任务, 之前的对话历史, 提示词版本) 的摘要为键，保存每轮的最终回答、各阶段记录和选择器状态。
+# 重跑时已完成的轮次直接恢复，不调用模型，从第一个缺失的轮次继续；被时间预算截断的轮次不保存，重跑时重新计算
+class RoundCheckpointStore:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS checkpoints (key TEXT PRIMARY KEY, name TEXT, round INTEGER, data BLOB, created_at REAL)")
+        self.db.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM checkpoints WHERE key = ?", (key,)).fetchone()
+        return json.loads(zlib.decompress(row[0]).decode("utf-8")) if row else None
+
+    def put(self, key, name, round_num, data):
+        blob = zlib.compress(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO checkpoints (key, name, round, data, created_at) VALUES (?, ?, ?, ?, ?)", (key, name, round_num, blob, time.time()))
+            self.db.commit()
+
+round_checkpoints = None  # 由 --checkpoint 打开
+prompt_version_tag = ""  # 由 --prompt_version 指定，以下摘要覆盖不到的流程改动可借此让旧检查点失效
+prompt_version_cache = None
+prompt_version_lock = threading.Lock()
+runtime_policy_keys = {"timeout", "retries", "backoff"}  # 只影响调用是否成功、不影响输出内容的策略项，不计入摘要
+
+# 影响模型输出的调用设置：各角色的调用策略（去掉 runtime_policy_keys）、结构化输出、模型路由、提示词变体等
+def pipeline_settings():
+    policies = {role: {key: value for key, value in policy.items() if key not in runtime_policy_keys}
+                for role, policy in call_policies.items()}
+    return {
+        "call_policies": policies,
+        "structured_output": structured_output,
+        "structured_formats": structured_formats if structured_output else None,
+        "model_routes": model_routes,
+        "prompt_variant": prompt_variant,
+        "parallel_integration_eval": parallel_integration_eval,
+    }
+
+# 提示词版本：所有代理（包括按流派生成的评估器）的系统提示词、模型名称、调用设置和版本标签的摘要
+def get_prompt_version():
+    global prompt_version_cache
+    with prompt_version_lock:
+        if prompt_version_cache is None:
+            prompts = sorted((agent.name, agent.system_message) for agent in prompt_agents().values())
+            models = [entry.get("model") for entry in config_list]
+            payload = [prompts, models, pipeline_settings(), prompt_version_tag]
+            prompt_version_cache = hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return prompt_version_cache
+
+def round_checkpoint_key(name, round_num, task, conversation_history):
+    return hashlib.sha256(json.dumps([name, round_num, task, conversation_history, get_prompt_version()], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+# 数据源：逐条产生 (名称, 对话)，对话为 ["求助者：...", "支持者：...", ...] 形式的列表。
+# keep(序号) 为 False 的条目不读取、不解析；序号在读取失败时同样递增，保证各分片的编号一致
+def iter_json_dir(path, keep):
+    for idx, json_file in enumerate(sorted(f for f in os.listdir(path) if f.endswith(".json"))):
+        if not keep(idx):
             continue
+        try:
+            with open(os.path.join(path, json_file), "r", encoding="utf-8") as f:
+                yield idx, json_file, json.load(f)
+        except Exception as e:
+            print(f"读取 {json_file} 出错: {e}")
 
-        dialogue_history = []
-        for task in user_messages:
-            task = clean_text(task.replace("求助者：", "").strip())
-            if not task:
-                print(f"警告：任务为空，跳过")
+# JSONL 导出：每行一条对话，可以是对话列表，或含 "dialogue"（可选 "id"）字段的对象
+def iter_jsonl(path, keep):
+    base = os.path.basename(path)
+    with open_results_stream(path, "r") as stream:
+        idx = -1
+        for line in stream:
+            if not line.strip():
+                continue
+            idx += 1
+            if not keep(idx):
+                continue
+            try:
+                record = json.loads(line)
+            except Exception as e:
+                print(f"读取 {base} 第 {idx+1} 条出错: {e}")
                 continue
+            if isinstance(record, dict):
+                yield idx, str(record.get("id", f"{base}:{idx+1}")), record.get("dialogue", [])
+            else:
+                yield idx, f"{base}:{idx+1}", record
 
-            print(f"处理任务：{task}")
-            current_chat_history[f"round_{round_num}"] = {}
+dataset_sources = {".jsonl": iter_jsonl, ".jsonl.gz": iter_jsonl, ".jsonl.zst": iter_jsonl}
 
-            # 运行通用型 Agent
-            general_result = run_general_agent(task, current_chat_history[f"round_{round_num}"], conversation_history)
-            general_text = clean_text(general_result.chat_history[-1]["content"], remove_think=True) if general_result and general_result.chat_history else "通用型 Agent 无输出"
+# 打开数据源：目录按 JSON 文件读取，文件按扩展名选择；shard=(i, n) 只保留序号模 n 余 i 的条目，limit 限制条数
+def open_dataset(path, shard=None, limit=None):
+    if os.path.isdir(path):
+        source = iter_json_dir
+    else:
+        source = next((source for suffix, source in dataset_sources.items() if path.endswith(suffix)), None)
+        if source is None:
+            raise ValueError(f"不支持的数据源: {path}")
+    shard_index, shard_count = shard or (0, 1)
+    count = 0
+    for item in source(path, lambda idx: idx % shard_count == shard_index):
+        if limit is not None and count >= limit:
+            return
+        count += 1
+        yield item
+
+# 在后台线程中预读数据源，文件读取和解析不占用处理对话的工作线程
+def prefetch(items, depth=16):
+    buffer = queue.Queue(maxsize=depth)
+
+    def produce():
+        try:
+            for item in items:
+                buffer.put(("item", item))
+            buffer.put(("done", None))
+        except Exception as e:
+            buffer.put(("error", e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        kind, value = buffer.get()
+        if kind == "done":
+            return
+        if kind == "error":
+            raise value
+        yield value
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"分片格式应为 i/n，例如 0/4: {value}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"分片序号应满足 0 <= i < n: {value}")
+    return index, count
+
+# 处理单条数据：每条数据使用独立的对话历史和选择器状态，并发运行时还使用独立的发送方代理
+def process_dialogue(idx, name, dialogue, round_budget=None, agents=None):
+    print(f"\n处理第 {idx+1} 条对话: {name}")
+    print(f"成功加载对话数据：{dialogue}")
+    current_chat_history = {}
+    conversation_history = []  # 每条数据独立对话历史
+    selector_state = {"last_selected_genres": [], "inactive_rounds": 0, "selector_active": True}
+    round_num = 1
+
+    # 提取求助者提问
+    user_messages = [msg for msg in dialogue if isinstance(msg, str) and msg.startswith("求助者：")]
+    if not user_messages:
+        print(f"警告：{name} 无求助者提问，跳过")
+        return None
 
-            # 选择流派
-            selected_genres = selector_function(task, current_chat_history[f"round_{round_num}"], conversation_history, selector_state, round_num)
-            print(f"选择的流派: {selected_genres}")
-
-            # 运行流派 Agents 和整合
-            final_result = general_text
-            if selected_genres:
-                genre_results = run_genre_agents(selected_genres, task, current_chat_history[f"round_{round_num}"], conversation_history)
-                if genre_results and any(result for result in genre_results):
-                    eval_results = run_evaluators(genre_results, current_chat_history[f"round_{round_num}"], task, conversation_history, selected_genres)
-                    final_result = integrate_results(selected_genres, genre_results, eval_results, current_chat_history[f"round_{round_num}"], general_text, round_num, task)
-                else:
-                    print("流派 Agent 运行失败，使用通用型 Agent 输出")
-                    current_chat_history[f"round_{round_num}"]["final"] = [{"content": f"直接输出通用型结果：{final_result} (流派 Agent 运行失败)", "role": "assistant"}]
-            else:
-                print("未选择流派，使用通用型 Agent 输出")
-                current_chat_history[f"round_{round_num}"]["final"] = [{"content": f"直接输出通用型结果：{final_result} (未选择流派)", "role": "assistant"}]
+    dialogue_history = []
+    for task in user_messages:
+        task = clean_text(task.replace("求助者：", "").strip())
+        if not task:
+            print(f"警告：任务为空，跳过")
+            continue
 
-            current_chat_history[f"round_{round_num}"]["final_result"] = final_result
-            conversation_history.append({"task": task, "result": final_result})
-            dialogue_history.append({"user": task, "assistant": final_result})
+        print(f"处理任务：{task}")
+        current_chat_history[f"round_{round_num}"] = {}
+        checkpoint_key = round_checkpoint_key(name, round_num, task, conversation_history) if round_checkpoints else None
+        checkpoint = round_checkpoints.get(checkpoint_key) if checkpoint_key else None
+        if checkpoint:
+            print(f"第 {round_num} 轮命中检查点，跳过模型调用")
+            count_metric("checkpoint.hit")
+            current_chat_history[f"round_{round_num}"] = checkpoint["chat_history"]
+            selector_state.update(checkpoint["selector_state"])
+            final_result = checkpoint["final_result"]
+        else:
+            if checkpoint_key:
+                count_metric("checkpoint.miss")
+            final_result = run_round(task, round_num, current_chat_history[f"round_{round_num}"], conversation_history, selector_state, round_budget=round_budget, agents=agents)
+            if checkpoint_key and not current_chat_history[f"round_{round_num}"].get("budget", {}).get("cut_stage"):
+                round_checkpoints.put(checkpoint_key, name, round_num, {
+                    "final_result": final_result,
+                    "chat_history": current_chat_history[f"round_{round_num}"],
+                    "selector_state": selector_state
+                })
+        conversation_history.append({"task": task, "result": final_result})
+        dialogue_history.append({"user": task, "assistant": final_result})
+
+        round_num += 1
+
+    return {
+        "test_id": idx + 1,
+        "file_name": name,
+        "dialogue": dialogue_history,
+        "chat_history": current_chat_history
+    }
+
+# worker 重启时不向上次（可能被中途终止、末尾已损坏的）分片追加，改写新的 shard_<worker_id>_<n> 分片
+def new_shard_file(output_dir, worker_id, results_format):
+    path = f"{output_dir}/shard_{worker_id}.{results_format}"
+    n = 1
+    while os.path.exists(path):
+        path = f"{output_dir}/shard_{worker_id}_{n}.{results_format}"
+        n += 1
+    return path
+
+# 测试主流程；workers > 1 时多条数据并发运行，同一阶段的流派与评估请求由批处理层合并派发。
+# results_format 为 jsonl / jsonl.gz / jsonl.zst 时逐条写入流式结果文件，内存占用与数据量无关；
+# data_dir 可以是 JSON 文件目录或 JSONL(.gz) 文件，shard 与 limit 见 open_dataset。
+# 指定 work_queue 时作为分布式 worker 运行：从队列领取对话，结果写入 output_dir 下的 shard_<worker_id> 分片文件，之后用 merge_shards 合并；
+# 指定 replay_from 时 data_dir 为之前保存的测试结果文件，按 replay_dialogue 只重跑下游阶段
+def run_test(data_dir, output_dir, round_budget=None, workers=1, results_format="json", shard=None, limit=None, work_queue=None, worker_id=None, replay_from=None):
+    if not work_queue and not os.path.exists(data_dir):
+        print(f"错误：数据源 {data_dir} 不存在")
+        return
+    os.makedirs(output_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    chat_file = f"{output_dir}/test_chat_history_{timestamp}.json"
+    results_file = f"{output_dir}/test_results_{timestamp}.json"
+    claim_slots = None
+    if work_queue:
+        worker_id = worker_id or default_worker_id()
+        init_work_queue(work_queue, open_dataset(data_dir, shard=shard, limit=limit) if data_dir else None)
+        start_lease_heartbeat(work_queue)
+        claim_slots = threading.BoundedSemaphore(workers) if workers > 1 else None
+        dialogues = iter_claims(work_queue, worker_id, slots=claim_slots)
+        results_format = "jsonl.gz" if results_format == "json" else results_format
+        results_file = new_shard_file(output_dir, worker_id, results_format)
+    elif replay_from:
+        shard_index, shard_count = shard or (0, 1)
+        records = (record for record in iter_test_results(data_dir) if (record["test_id"] - 1) % shard_count == shard_index)
+        dialogues = prefetch(((record["test_id"] - 1, record["file_name"], record) for record in itertools.islice(records, limit)), depth=max(16, workers * 4))
+    else:
+        dialogues = prefetch(open_dataset(data_dir, shard=shard, limit=limit), depth=max(16, workers * 4))
 
-            round_num += 1
+    test_results = []
+    budget_cuts = {}
+    save_lock = threading.Lock()
+    store = new_message_store()
+    stream = None
+    if results_format != "json":
+        if not work_queue:
+            results_file = f"{output_dir}/test_results_{timestamp}.{results_format}"
+        stream = open_results_stream(results_file, "w")
+
+    def run_one(idx, name, dialogue):
+        agents = new_session_agents() if workers > 1 else None
+        try:
+            if replay_from:
+                test_result = replay_dialogue(idx, dialogue, from_stage=replay_from, round_budget=round_budget, agents=agents)
+            else:
+                test_result = process_dialogue(idx, name, dialogue, round_budget=round_budget, agents=agents)
+        except Exception as e:
+            if not work_queue:
+                raise
+            print(f"处理第 {idx+1} 条对话出错: {e}")
+            work_queue.fail(idx)
+            return
+        finally:
+            if agents:
+                release_session_agents(agents)
+        if test_result is None:
+            if work_queue:
+                work_queue.complete(idx)
+            return
+        with save_lock:
+            for round_history in test_result["chat_history"].values():
+                cut_stage = round_history.get("budget", {}).get("cut_stage")
+                if cut_stage:
+                    budget_cuts[cut_stage] = budget_cuts.get(cut_stage, 0) + 1
+
+        # 流式写入：每条记录自带其引用的消息正文
+        if stream:
+            messages = new_message_store()
+            if messages is not None:
+                test_result["chat_history"] = intern_messages(test_result["chat_history"], messages)
+                test_result["messages"] = messages
+            with save_lock:
+                write_result_record(stream, test_result)
+            if work_queue:
+                work_queue.complete(idx)
+            print(f"写入第 {idx+1} 条测试结果到: {results_file}")
+            return
+
+        # 保存单条测试结果和聊天历史
+        test_result["chat_history"] = intern_messages(test_result["chat_history"], store)
+        with save_lock:
+            test_results.append(test_result)
+            all_chat_history[f"test_{idx+1}"] = test_result["chat_history"]
+            try:
+                save_chat_history(chat_file, all_chat_history, store)
+                print(f"保存聊天历史到: {chat_file}")
+            except Exception as e:
+                print(f"保存聊天历史出错: {e}")
 
-        # 保存单条测试结果
-        test_results.append({
-            "test_id": idx + 1,
-            "file_name": json_file,
-            "dialogue": dialogue_history,
-            "chat_history": current_chat_history
-        })
+    # 并发时最多提交 workers * 2 条，避免一次读入整个数据集；从队列领取时由 iter_claims 先占用空闲槽位再领取，
+    # 不多领，空闲任务留给其他 worker
+    dialogue_count = 0
+    try:
+        if workers > 1:
+            slots = claim_slots or threading.BoundedSemaphore(workers * 2)
+            futures = []
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for idx, name, dialogue in dialogues:
+                    dialogue_count += 1
+                    if not claim_slots:
+                        slots.acquire()
+                    future = executor.submit(run_one, idx, name, dialogue)
+                    future.add_done_callback(lambda _: slots.release())
+                    futures.append(future)
+                for future in futures:
+                    future.result()
+        else:
+            for idx, name, dialogue in dialogues:
+                dialogue_count += 1
+                run_one(idx, name, dialogue)
+    finally:
+        if stream:
+            stream.close()
+
+    if not dialogue_count:
+        print(f"错误：{data_dir} 中没有可读取的对话" if not work_queue else "任务队列中没有待处理的对话")
+    if work_queue:
+        print(f"任务队列状态: {work_queue.stats()}")
+        failed = work_queue.failed_tasks()
+        if failed:
+            print(f"警告：以下对话出错 {work_queue.max_attempts} 次后不再重试: {[idx + 1 for idx in failed]}")
 
-        # 保存聊天历史
-        all_chat_history[f"test_{idx+1}"] = copy.deepcopy(current_chat_history)
+    # 保存所有测试结果
+    if stream:
+        print(f"保存测试结果到: {results_file}")
+    else:
+        test_results.sort(key=lambda result: result["test_id"])
         try:
-            with open(chat_file, "w", encoding="utf-8") as f:
-                json.dump(all_chat_history, f, ensure_ascii=False, indent=4)
-            print(f"保存聊天历史到: {chat_file}")
+            save_chat_history(results_file, test_results, store)
+            print(f"保存测试结果到: {results_file}")
         except Exception as e:
-            print(f"保存聊天历史出错: {e}")
+            print(f"保存测试结果出错: {e}")
+    if budget_cuts:
+        print(f"时间预算截断统计（阶段: 轮数）: {budget_cuts}")
+    try:
+        with open(f"{output_dir}/call_metrics_{timestamp}.json", "w", encoding="utf-8") as f:
+            json.dump(metrics_summary(), f, ensure_ascii=False, indent=4)
+    except Exception as e:
+        print(f"保存调用指标出错: {e}")
 
-    # 保存所有测试结果
+# 合并各 worker 的分片结果，生成标准的 test_results / test_chat_history 文件；同一条对话被重复处理时保留先读到的结果
+def merge_shards(output_dir, work_queue=None):
+    shard_files = sorted(f for f in os.listdir(output_dir) if f.startswith("shard_") and ".jsonl" in f)
+    if not shard_files:
+        print(f"错误：{output_dir} 中没有分片文件")
+        return
+    merged, duplicates = {}, 0
+    store = new_message_store()
+    for shard_file in shard_files:
+        for record in read_results_stream(os.path.join(output_dir, shard_file)):
+            if record["test_id"] in merged:
+                duplicates += 1
+                continue
+            record["chat_history"] = intern_messages(record["chat_history"], store)
+            merged[record["test_id"]] = record
+    test_results = [merged[test_id] for test_id in sorted(merged)]
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     try:
-        with open(results_file, "w", encoding="utf-8") as f:
-            json.dump(test_results, f, ensure_ascii=False, indent=4)
-        print(f"保存测试结果到: {results_file}")
+        save_chat_history(f"{output_dir}/test_chat_history_{timestamp}.json", {f"test_{record['test_id']}": record["chat_history"] for record in test_results}, store)
+        save_chat_history(f"{output_dir}/test_results_{timestamp}.json", test_results, store)
+        print(f"合并 {len(shard_files)} 个分片，共 {len(test_results)} 条结果（重复 {duplicates} 条），保存到: {output_dir}/test_results_{timestamp}.json")
     except Exception as e:
-        print(f"保存测试结果出错: {e}")
+        print(f"保存合并结果出错: {e}")
+    if work_queue:
+        stats = work_queue.stats()
+        print(f"任务队列状态: {stats}")
+        if stats["pending"] or stats["leased"]:
+            print("警告：队列中仍有未完成的对话，合并结果不完整")
+        failed = work_queue.failed_tasks()
+        if failed:
+            print(f"警告：以下对话出错 {work_queue.max_attempts} 次后不再重试，未包含在合并结果中: {[idx + 1 for idx in failed]}")
 
 if __name__ == "__main__":
     # 数据目录和输出目录
     parser = argparse.ArgumentParser(description="Run CPsyCounE test with specified data and output directories")
-    parser.add_argument('--data_dir', type=str, required=True, help="Path to the data directory")
+    parser.add_argument('--data_dir', type=str, default=None, help="Directory of JSON dialogue files, or a .jsonl / .jsonl.gz / .jsonl.zst file with one dialogue per line")
     parser.add_argument('--output_dir', type=str, required=True, help="Path to the output directory")
+    parser.add_argument('--round_budget', type=float, default=None, help="Per-round latency budget in seconds; the best available answer is returned when it runs out")
+    parser.add_argument('--call_policy', type=str, default=None, help="JSON file overriding per-role timeout/retries/backoff")
+    parser.add_argument('--structured_output', action='store_true', help="Constrain selector and evaluator output with a JSON schema and send a short repair prompt on format violations")
+    parser.add_argument('--warmup', action='store_true', help="Load every configured model on all its backends concurrently before the first round and report cold-load time")
+    parser.add_argument('--warmup_prefill', action='store_true', help="Warm up and also prefill each model with its longest static system prompt")
+    parser.add_argument('--keep_alive', type=parse_keep_alive, default=None, help="Ollama keep_alive sent with warm-up and every CustomOllamaClient call, e.g. -1 to keep models loaded for the run")
+    parser.add_argument('--near_cache_threshold', type=float, default=None, help="Serve early rounds from a near-duplicate earlier round when the MinHash similarity of task and history reaches this threshold (e.g. 0.6)")
+    parser.add_argument('--near_cache_rounds', type=int, default=2, help="Only rounds up to this number use the near-duplicate cache")
+    parser.add_argument('--num_ctx', type=int, default=None, help="Context length (tokens) passed to Ollama as num_ctx; older conversation history is trimmed to fit it")
+    parser.add_argument('--prompt_variant', type=str, default="full", choices=["full", "compact"], help="System prompt variant: the full prompts, or compact ones without examples and duplicated boilerplate")
+    parser.add_argument('--model_routes', type=str, default=None, help="JSON file mapping roles to primary/fallback models (and optional downgrade thresholds)")
+    parser.add_argument('--compact_history', action='store_true', help="Save chat history and results in the deduplicated message store format (message_store_v1) instead of plain indented JSON")
+    parser.add_argument('--results_format', type=str, default="json", choices=["json", "jsonl", "jsonl.gz", "jsonl.zst"], help="Write results as one JSON document, or stream one JSON line per dialogue (optionally gzip/zstd compressed)")
+    parser.add_argument('--limit', type=int, default=None, help="Process at most this many dialogues (after sharding)")
+    parser.add_argument('--shard', type=parse_shard, default=None, help="Process only shard i of n, e.g. 0/4")
+    parser.add_argument('--queue', type=str, default=None, help="Shared work queue (a directory, or a .db file for a local SQLite queue); run as a distributed worker")
+    parser.add_argument('--worker_id', type=str, default=None, help="Worker name used for the shard output file (default: hostname-pid)")
+    parser.add_argument('--lease_seconds', type=float, default=600, help="Claimed dialogues whose lease is not renewed within this time are reassigned")
+    parser.add_argument('--max_attempts', type=int, default=3, help="Requeue a dialogue that raised an error until it has failed this many times")
+    parser.add_argument('--replay', type=str, default=None, help="Previous test_results file to replay; the stored general/selector/genre outputs are reused")
+    parser.add_argument('--from_stage', '--from-stage', type=str, default="evaluators", choices=replay_stages, help="First stage rerun when replaying")
+    parser.add_argument('--checkpoint', type=str, default=None, help="SQLite file of per-round checkpoints; completed rounds are restored without model calls on rerun")
+    parser.add_argument('--prompt_version', type=str, default="", help="Extra version tag mixed into checkpoint keys, to invalidate them after non-prompt pipeline changes")
+    parser.add_argument('--merge', action='store_true', help="Merge shard outputs in --output_dir into the standard results files and exit")
+    parser.add_argument('--workers', type=int, default=1, help="Number of dialogues processed concurrently")
+    parser.add_argument('--batch_window_ms', type=float, default=0, help="How long genre/evaluator requests wait to be batched with others, e.g. 5; 0 (default) disables batching")
+    parser.add_argument('--batch_size', type=int, default=8, help="Maximum requests per batch")
+    parser.add_argument('--batch_slots', type=int, default=8, help="Parallel request slots the backend serves")
+    parser.add_argument('--model_concurrency', type=int, default=0, help="Maximum in-flight requests per backend model, for models whose config entry sets no max_concurrency; 0 means unlimited")
+    parser.add_argument('--speculative_general', action='store_true', help="Start the general agent alongside the selector and genre stages and only wait for it when a fallback needs its text")
+    parser.add_argument('--serial_integration_eval', action='store_true', help="Run integration evaluators one after another, each seeing the previous evaluators' output as carryover context")
     
     # 解析命令行参数
     args = parser.parse_args()
+    if not args.data_dir and not (args.queue or args.merge or args.replay):
+        parser.error("--data_dir is required unless --queue, --merge or --replay is given")
+    if args.replay and args.queue:
+        parser.error("--replay cannot be combined with --queue")
     
     # 使用命令行传入的目录
     data_dir = args.data_dir
     output_dir = args.output_dir
+    if args.call_policy:
+        load_call_policies(args.call_policy)
+    if args.model_routes:
+        load_model_routes(args.model_routes)
+    if args.prompt_variant != "full":
+        apply_prompt_variant(args.prompt_variant)
+    if args.num_ctx:
+        call_policies["default"]["num_ctx"] = args.num_ctx
+    if args.near_cache_threshold is not None:
+        near_cache = NearDuplicateCache(args.near_cache_threshold, max_rounds=args.near_cache_rounds)
+    configure_request_batching(args.batch_window_ms, args.batch_size, args.batch_slots)
+    configure_model_scheduler(args.model_concurrency)
+    compact_history = args.compact_history
+    speculative_general = args.speculative_general
+    parallel_integration_eval = not args.serial_integration_eval
+    structured_output = args.structured_output
+    keep_alive = args.keep_alive
+    if (args.warmup or args.warmup_prefill) and not args.merge:
+        warmup_models(prefill=args.warmup_prefill)
     
-    run_test(data_dir, output_dir)
\ No newline at end of file
+    work_queue = open_work_queue(args.queue, args.lease_seconds, args.max_attempts) if args.queue else None
+    round_checkpoints = RoundCheckpointStore(args.checkpoint) if args.checkpoint else None
+    prompt_version_tag = args.prompt_version
+    if args.merge:
+        merge_shards(output_dir, work_queue)
+    else:
+        run_test(args.replay or data_dir, output_dir, round_budget=args.round_budget, workers=args.workers, results_format=args.results_format, shard=args.shard, limit=args.limit, work_queue=work_queue, worker_id=args.worker_id, replay_from=args.from_stage if args.replay else None)
\ No newline at end of file